@@ -23,6 +23,8 @@ import os
 import subprocess
 from subprocess import Popen, PIPE, CalledProcessError
 
+from UbuntuDrivers import kmodindex
+
 
 class MultiArchUtils(object):
 
@@ -150,6 +152,11 @@ class Alternatives(object):
 
     def resolve_module_alias(self, alias):
         '''Get the 1st kernel module name matching an alias'''
+        modules = kmodindex.resolve_alias(alias)
+        if modules is not None:
+            return modules[0] if modules else None
+
+        # no module index for the running kernel, ask modprobe
         dev_null = open('/dev/null', 'w')
         p1 = Popen(['modprobe', '--resolve-alias', alias], stdout=PIPE,
                    stderr=dev_null, universal_newlines=True)
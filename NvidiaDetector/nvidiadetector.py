@@ -28,6 +28,8 @@ import sys
 import logging
 import apt
 
+from UbuntuDrivers.aptscan import prefix_index
+
 obsoletePackagesPath = '/usr/share/ubuntu-drivers-common/obsolete'
 
 
@@ -143,9 +145,10 @@ class NvidiaDetection(object):
         self.drivers = {}
         vendor_product_re = re.compile('pci:v0000(.+)d0000(.+)sv')
 
-        for package in apt.Cache():
-            if (not package.name.startswith('nvidia-') or
-                    'updates' in package.name or
+        cache = apt.Cache()
+        for name in prefix_index(cache).names('nvidia-'):
+            package = cache[name]
+            if ('updates' in package.name or
                     'experimental' in package.name or
                     'current' in package.name):
                 continue
@@ -0,0 +1,295 @@
+'''Fast scanning of the apt cache with the low-level apt_pkg objects.'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import bisect
+import logging
+import weakref
+
+import apt_pkg
+
+
+class RawCache(object):
+    '''The apt_pkg.Cache, DepCache and PackageRecords behind an apt.Cache.
+
+    Iterating over an apt.Cache creates an apt.Package object for every
+    package, and an apt.Version object and a parsed record for every candidate
+    which gets looked at. The scanning functions here work on the apt_pkg
+    objects directly, and only produce names and records for the packages they
+    return.
+    '''
+
+    def __init__(self, apt_cache):
+        self.cache = apt_cache._cache
+        self.depcache = apt_cache._depcache
+        self.records = apt_cache._records
+
+    def packages(self):
+        '''Iterate over all apt_pkg.Package objects which have versions.'''
+
+        for pkg in self.cache.packages:
+            if pkg.has_versions:
+                yield pkg
+
+    @staticmethod
+    def name(pkg):
+        '''Return the name of an apt_pkg.Package like apt.Package.name.'''
+
+        return pkg.get_fullname(True)
+
+    @staticmethod
+    def is_installed(pkg):
+        return pkg.current_ver is not None
+
+    def marked_install(self, pkg):
+        return self.depcache.marked_install(pkg)
+
+    def candidate(self, pkg):
+        '''Return the candidate apt_pkg.Version of a package, or None.'''
+
+        return self.depcache.get_candidate_ver(pkg)
+
+    def record(self, ver):
+        '''Return the record of an apt_pkg.Version as a string, or None.'''
+
+        try:
+            if not self.records.lookup(ver.file_list[0]):
+                return None
+            return self.records.record
+        except (IndexError, UnicodeDecodeError):
+            return None
+
+    def candidate_records(self, field, architectures):
+        '''Iterate over the candidate versions which have a particular field.
+
+        Only candidates for the given architectures are considered, and their
+        records are only parsed if they contain the field.
+
+        Yield (package name, apt_pkg.TagSection) pairs.
+        '''
+        for pkg in self.packages():
+            ver = self.candidate(pkg)
+            if ver is None or ver.arch not in architectures:
+                continue
+            text = self.record(ver)
+            if text is None or (field + ':') not in text:
+                continue
+            section = apt_pkg.TagSection(text)
+            if field in section:
+                yield (self.name(pkg), section)
+
+    def package(self, name):
+        '''Return the apt_pkg.Package for a name as returned by name().'''
+
+        return self.cache[name]
+
+    def marked_install_names(self):
+        '''Return the names of all packages which are marked for installation.'''
+
+        if self.depcache.inst_count == 0:
+            return []
+        return [self.name(pkg) for pkg in self.packages() if self.depcache.marked_install(pkg)]
+
+    def reverse_depends(self, package):
+        '''Return the names of packages which depend on package.
+
+        This follows the reverse dependencies of the package (of all
+        architectures), so it only looks at the actual reverse dependencies.
+        Like find_reverse_dependencies(), only the Depends of the candidate and
+        the installed version count.
+        '''
+        deps = set()
+        try:
+            group = apt_pkg.Group(self.cache, package)
+        except KeyError:
+            return deps
+        for target in group:
+            for dep in target.rev_depends_list:
+                if dep.dep_type_untranslated != 'Depends':
+                    continue
+                pkg = dep.parent_pkg
+                versions = [v.id for v in (self.candidate(pkg), pkg.current_ver) if v is not None]
+                if dep.parent_ver.id in versions:
+                    deps.add(self.name(pkg))
+        return deps
+
+
+class ReverseDependsIndex(object):
+    '''Reverse Depends of all packages of an apt.Cache-like object.
+
+    This is for caches without apt_pkg objects (see raw_cache()). It is built
+    in a single pass over the candidate and installed versions.
+    '''
+
+    def __init__(self, apt_cache):
+        self._rdepends = {}
+        for pkg in apt_cache:
+            for ver in (pkg.candidate, pkg.installed):
+                if ver is None:
+                    continue
+                for ordep in ver.dependencies:
+                    for dep in ordep:
+                        if dep.rawtype == 'Depends':
+                            self._rdepends.setdefault(dep.name, set()).add(pkg.name)
+
+    def reverse_depends(self, package):
+        '''Return the names of packages which depend on package.'''
+
+        return set(self._rdepends.get(package, ()))
+
+
+class PrefixIndex(object):
+    '''Package names of a cache, bucketed by their first name component.
+
+    A lookup for a prefix like "linux-image-" or "nvidia-" only looks at the
+    bucket of the first component ("linux" or "nvidia"), instead of iterating
+    over the whole cache.
+    '''
+
+    def __init__(self, names):
+        self._buckets = {}
+        for name in names:
+            self._buckets.setdefault(name.split('-', 1)[0], []).append(name)
+        for bucket in self._buckets.values():
+            bucket.sort()
+
+    def names(self, prefix):
+        '''Return the sorted names which start with prefix.'''
+
+        if '-' in prefix:
+            buckets = [self._buckets.get(prefix.split('-', 1)[0], [])]
+        else:
+            # the prefix can extend into the first component of other buckets
+            buckets = [b for k, b in sorted(self._buckets.items()) if k.startswith(prefix)]
+
+        result = []
+        for bucket in buckets:
+            i = bisect.bisect_left(bucket, prefix)
+            while i < len(bucket) and bucket[i].startswith(prefix):
+                result.append(bucket[i])
+                i += 1
+        return result
+
+    def __len__(self):
+        return sum(len(b) for b in self._buckets.values())
+
+
+def raw_cache(apt_cache):
+    '''Get the RawCache for an apt.Cache object.
+
+    Return None for other cache implementations (such as PackageLists), which
+    then need to be scanned through their apt.Cache-like interface.
+    '''
+    try:
+        return RawCache(apt_cache)
+    except AttributeError:
+        logging.debug('aptscan: %s has no apt_pkg cache, using slow path', type(apt_cache).__name__)
+        return None
+
+
+class CacheMemo(object):
+    '''A value which is computed once for each apt.Cache (or PackageLists) object.
+
+    build is called with a cache to compute its value. Values only hold a weak
+    reference to their cache, and get rebuilt after the cache was reopened
+    (e. g. after an update). With generation=True, they also get rebuilt when
+    the generation() of the cache changed, i. e. after packages got (un)marked.
+    '''
+
+    # cache → [number of reopens, number of changes]
+    _counters = weakref.WeakKeyDictionary()
+
+    def __init__(self, build, generation=False):
+        self.build = build
+        self.generation = generation
+        self._values = weakref.WeakKeyDictionary()
+
+    @classmethod
+    def counters(cls, apt_cache):
+        '''Return the [reopens, changes] counters of a cache.
+
+        The signals of each cache are only connected once, for all memos.
+        '''
+        try:
+            return cls._counters[apt_cache]
+        except KeyError:
+            counters = cls._counters[apt_cache] = [0, 0]
+
+            def changed(i):
+                counters[i] += 1
+
+            apt_cache.connect('cache_post_open', lambda: changed(0))
+            apt_cache.connect('cache_post_change', lambda: changed(1))
+            return counters
+
+    def get(self, apt_cache):
+        '''Return the value for apt_cache, building it if necessary.'''
+
+        counters = CacheMemo.counters(apt_cache)
+        stamp = self.generation and tuple(counters) or counters[0]
+        entry = self._values.get(apt_cache)
+        if entry is None or entry[0] != stamp:
+            entry = self._values[apt_cache] = (stamp, self.build(apt_cache))
+        return entry[1]
+
+    def invalidate(self, apt_cache=None):
+        '''Drop the value for apt_cache, or all values if not given.'''
+
+        if apt_cache is None:
+            self._values.clear()
+        else:
+            self._values.pop(apt_cache, None)
+
+    def __len__(self):
+        return len(self._values)
+
+
+def generation(apt_cache):
+    '''Return the generation of an apt.Cache (or PackageLists) object.
+
+    This is a counter which goes up whenever packages get (un)marked or the
+    cache gets reopened, so that results which depend on the marks can be kept
+    until the next change. It is 0 for caches which never change.
+    '''
+    return sum(CacheMemo.counters(apt_cache))
+
+
+def marked_install_names(apt_cache):
+    '''Return the names of all packages which are marked for installation.'''
+
+    raw = raw_cache(apt_cache)
+    if raw is not None:
+        return raw.marked_install_names()
+    return [pkg.name for pkg in apt_cache if pkg.marked_install]
+
+
+def reverse_depends(apt_cache, package):
+    '''Return the names of packages which depend on package.
+
+    These are the packages whose candidate or installed version has package
+    in its Depends.
+    '''
+    raw = raw_cache(apt_cache)
+    if raw is not None:
+        return raw.reverse_depends(package)
+    return reverse_depends.memo.get(apt_cache).reverse_depends(package)
+
+
+reverse_depends.memo = CacheMemo(ReverseDependsIndex)
+
+
+def prefix_index(apt_cache):
+    '''Get the PrefixIndex of an apt.Cache (or PackageLists) object.
+
+    The index is built from the package names in a single pass, and shared
+    until the cache gets reopened.
+    '''
+    return prefix_index.memo.get(apt_cache)
+
+
+prefix_index.memo = CacheMemo(lambda apt_cache: PrefixIndex(apt_cache.keys()))
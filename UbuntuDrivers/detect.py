@@ -9,6 +9,8 @@
 # (at your option) any later version.
 
 import os
+import copy
+import json
 import logging
 import fnmatch
 import subprocess
@@ -17,21 +19,252 @@ import re
 
 import apt
 
+from UbuntuDrivers import aptscan
+from UbuntuDrivers import hwdb
 from UbuntuDrivers import kerneldetection
+from UbuntuDrivers import kmodindex
+from UbuntuDrivers import modaliasindex
+from UbuntuDrivers.modaliasmatcher import ModaliasMatcher, ModaliasMatcherCache
 
 system_architecture = apt.apt_pkg.get_architectures()[0]
 
 
-def system_modaliases(sys_path=None):
+def _read_device_modalias(path):
+    '''Read the modalias of a sysfs device directory.
+
+    Return None if the device does not have a modalias.
+    '''
+    try:
+        with open(os.path.join(path, 'modalias')) as f:
+            return f.read().strip()
+    except FileNotFoundError:
+        pass
+    except IOError as e:
+        logging.debug('system_modaliases(): Cannot read %s/modalias: %s',
+                      path, e)
+        return None
+
+    # devices on SSB bus only mention the modalias in the uevent file (as
+    # of 2.6.24)
+    if 'ssb' in path:
+        try:
+            with open(os.path.join(path, 'uevent')) as fd:
+                for line in fd:
+                    if line.startswith('MODALIAS='):
+                        return line.split('=', 1)[1].strip()
+        except IOError:
+            pass
+
+    return None
+
+
+def _has_builtin_driver(path, driver_cache):
+    '''Check if the device at the given sysfs path is bound to a built-in driver.
+
+    driver_cache maps driver directories to the result, so that the module
+    link of a driver only needs to be checked once for all of its devices.
+    '''
+    try:
+        driver = os.readlink(os.path.join(path, 'driver'))
+    except OSError:
+        return False
+
+    driver = os.path.normpath(os.path.join(path, driver))
+    try:
+        return driver_cache[driver]
+    except KeyError:
+        builtin = not os.path.islink(os.path.join(driver, 'module'))
+        driver_cache[driver] = builtin
+        return builtin
+
+
+def _bus_device_paths(sys_path, buses=None):
+    '''Iterate over the devices which are registered on a bus or class in sysfs.
+
+    This enumerates sys_path/bus/*/devices/ and sys_path/class/*/ instead of
+    walking the whole device tree. The nodes in sys_path/devices/system/ (e. g.
+    "cpu", whose modalias lists the CPU features) are not on any bus or class,
+    so these are checked directly. With buses, only the bus directories of
+    these are scanned, but all classes are, as these are not named by bus.
+
+    Yield resolved sysfs device paths.
+    '''
+    device_dirs = []
+    with os.scandir(os.path.join(sys_path, 'bus')) as it:
+        for entry in it:
+            if buses is None or entry.name in buses:
+                device_dirs.append(os.path.join(entry.path, 'devices'))
+    try:
+        with os.scandir(os.path.join(sys_path, 'class')) as it:
+            for entry in it:
+                device_dirs.append(entry.path)
+    except OSError:
+        pass
+
+    seen = set()
+    try:
+        with os.scandir(os.path.join(sys_path, 'devices', 'system')) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    seen.add(entry.path)
+                    yield entry.path
+    except OSError:
+        pass
+
+    for devices in device_dirs:
+        try:
+            it = os.scandir(devices)
+        except OSError:
+            continue
+        with it:
+            for entry in it:
+                # the entries are symlinks into sys_path/devices/; resolve
+                # them without stat()ing every path component
+                try:
+                    path = os.path.normpath(os.path.join(devices, os.readlink(entry.path)))
+                except OSError:
+                    path = entry.path
+                if path not in seen:
+                    seen.add(path)
+                    yield path
+
+
+def _uevent_state(sys_path):
+    '''Get the boot ID and the current uevent sequence number.
+
+    The kernel bumps the sequence number on every uevent, so the pair is
+    unchanged as long as no device was added, removed or (un)bound.
+
+    Return None if the state cannot be determined.
+    '''
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            boot_id = f.read().strip()
+        with open(os.path.join(sys_path, 'kernel', 'uevent_seqnum')) as f:
+            seqnum = int(f.read().strip())
+    except (IOError, ValueError):
+        return None
+    return [boot_id, seqnum]
+
+
+# bump this when the layout of the snapshot changes
+MODALIAS_SNAPSHOT_FORMAT = 1
+
+
+def _modalias_snapshot_path():
+    return os.path.join(os.environ.get('UBUNTU_DRIVERS_CACHE_DIR', '/var/lib/ubuntu-drivers-common'),
+                        'modaliases.json')
+
+
+def _load_modalias_snapshot(key):
+    '''Load the system_modaliases() snapshot if it is still valid for key.'''
+
+    try:
+        with open(_modalias_snapshot_path()) as f:
+            snapshot = json.load(f)
+    except (IOError, ValueError):
+        return None
+    if not isinstance(snapshot, dict) or snapshot.get('key') != key:
+        return None
+    logging.debug('system_modaliases(): using snapshot for uevent state %s', key)
+    return snapshot.get('aliases')
+
+
+def _save_modalias_snapshot(key, aliases):
+    '''Save a system_modaliases() snapshot for key.'''
+
+    path = _modalias_snapshot_path()
+    try:
+        with open(path + '.new', 'w') as f:
+            json.dump({'key': key, 'aliases': aliases}, f)
+        os.rename(path + '.new', path)
+    except (IOError, OSError) as e:
+        logging.debug('system_modaliases(): Cannot write snapshot %s: %s', path, e)
+
+
+def iter_system_modaliases(sys_path=None, buses=None):
+    '''Iterate over the modaliases present in the system.
+
+    This yields (modalias, sysfs path) pairs while sysfs is being scanned, so
+    that callers can start matching before the scan is finished, or stop as soon
+    as they found what they need. Devices which share a modalias are yielded
+    individually.
+
+    This follows the same rules as system_modaliases(). The result of a
+    complete scan is kept in a snapshot in /var/lib/ubuntu-drivers-common/ (or
+    $UBUNTU_DRIVERS_CACHE_DIR), which is reused as long as the system was not
+    rebooted and no uevent happened since.
+    '''
+    sys_path = sys_path or '/sys'
+    state = _uevent_state(sys_path)
+    if state:
+        key = [MODALIAS_SNAPSHOT_FORMAT, os.path.abspath(sys_path),
+               sorted(buses) if buses is not None else None] + state
+        aliases = _load_modalias_snapshot(key)
+        if aliases is not None:
+            for alias, paths in aliases.items():
+                for path in paths:
+                    yield (alias, path)
+            return
+
+    if os.path.isdir(os.path.join(sys_path, 'bus')):
+        devices = _iter_bus_modaliases(sys_path, buses)
+    else:
+        devices = _iter_walk_modaliases(sys_path, buses)
+
+    aliases = {}
+    for alias, path in devices:
+        aliases.setdefault(alias, []).append(path)
+        yield (alias, path)
+
+    # only save the snapshot if nothing changed while scanning
+    if state and _uevent_state(sys_path) == state:
+        _save_modalias_snapshot(key, aliases)
+
+
+def system_modalias_devices(sys_path=None, buses=None):
+    '''Get modaliases present in the system, with all devices that have them.
+
+    This is like system_modaliases(), but does not collapse devices which share
+    the same modalias (such as identical GPUs or SR-IOV virtual functions).
+
+    Return a modalias → [sysfs path, ...] map.
+    '''
+    aliases = {}
+    for alias, path in iter_system_modaliases(sys_path, buses):
+        aliases.setdefault(alias, []).append(path)
+    return aliases
+
+
+def system_modaliases(sys_path=None, buses=None):
     '''Get modaliases present in the system.
 
     This ignores devices whose drivers are statically built into the kernel, as
     you cannot replace them with other driver packages anyway.
 
+    If the sysfs tree has a bus/ directory, only devices which are registered on
+    a bus or class (plus the nodes in devices/system/, like the CPU) are
+    considered, which is a lot cheaper than walking all of /sys/devices and
+    finds the same modaliases. buses can be a list of modalias prefixes (e. g.
+    ['pci', 'usb', 'dmi']) to only return these.
+
+    If several devices have the same modalias, only the last one is returned;
+    use system_modalias_devices() to get all of them.
+
     Return a modalias → sysfs path map.
     '''
     aliases = {}
-    devices = sys_path and '%s/devices' % (sys_path) or '/sys/devices'
+    for alias, path in iter_system_modaliases(sys_path, buses):
+        aliases[alias] = path
+    return aliases
+
+
+def _iter_walk_modaliases(sys_path, buses=None):
+    '''Iterate over modaliases by walking the whole sysfs device tree.
+
+    This is the fallback of iter_system_modaliases() for trees without bus/.
+    '''
+    devices = os.path.join(sys_path, 'devices')
     for path, dirs, files in os.walk(devices):
         modalias = None
 
@@ -57,6 +290,9 @@ def system_modaliases(sys_path=None):
         if not modalias:
             continue
 
+        if buses is not None and modalias.split(':', 1)[0] not in buses:
+            continue
+
         # ignore drivers which are statically built into the kernel
         driverlink = os.path.join(path, 'driver')
         modlink = os.path.join(driverlink, 'module')
@@ -64,22 +300,62 @@ def system_modaliases(sys_path=None):
             # logging.debug('system_modaliases(): ignoring device %s which has no module (built into kernel)', path)
             continue
 
-        aliases[modalias] = path
+        yield (modalias, path)
 
-    return aliases
 
+def _iter_bus_modaliases(sys_path, buses=None):
+    '''Iterate over modaliases of the devices registered on a bus in sysfs.
 
-def _check_video_abi_compat(apt_cache, record):
-    xorg_video_abi = None
+    This is the fast path of iter_system_modaliases().
+    '''
+    driver_cache = {}
+    for path in _bus_device_paths(sys_path, buses):
+        modalias = _read_device_modalias(path)
+        if not modalias:
+            continue
+
+        if buses is not None and modalias.split(':', 1)[0] not in buses:
+            continue
 
-    # determine current X.org video driver ABI
+        # ignore drivers which are statically built into the kernel
+        if _has_builtin_driver(path, driver_cache):
+            continue
+
+        yield (modalias, path)
+
+
+def _resolve_xorg_video_abi(apt_cache):
+    '''Determine the current X.org video driver ABI.
+
+    Return the xorg-video-abi-* package which the xserver-xorg-core candidate
+    provides, '' if it does not provide any, or None if xserver-xorg-core is
+    not available.
+    '''
     try:
         for p in apt_cache['xserver-xorg-core'].candidate.provides:
             if p.startswith('xorg-video-abi-'):
-                xorg_video_abi = p
-                # logging.debug('_check_video_abi_compat(): Current X.org video abi: %s', xorg_video_abi)
-                break
+                logging.debug('_check_video_abi_compat(): Current X.org video abi: %s', p)
+                return p
     except (AttributeError, KeyError):
+        return None
+    return ''
+
+
+def _xorg_video_abi(apt_cache):
+    '''Get the current X.org video driver ABI of an apt.Cache object.
+
+    This is resolved once and kept until the cache gets reopened. See
+    _resolve_xorg_video_abi() for the return value.
+    '''
+    return _xorg_video_abi.memo.get(apt_cache)
+
+
+_xorg_video_abi.memo = aptscan.CacheMemo(_resolve_xorg_video_abi)
+
+
+def _check_video_abi_compat(apt_cache, record):
+    xorg_video_abi = _xorg_video_abi(apt_cache)
+    if xorg_video_abi is None:
         logging.debug('_check_video_abi_compat(): xserver-xorg-core not available, cannot check ABI')
         return True
     if not xorg_video_abi:
@@ -96,16 +372,54 @@ def _check_video_abi_compat(apt_cache, record):
     return True
 
 
-def _apt_cache_modalias_map(apt_cache):
+def _add_package_modaliases(result, name, modaliases):
+    '''Add the patterns of a Modaliases header to a modalias map.'''
+
+    try:
+        for part in modaliases.split(')'):
+            part = part.strip(', ')
+            if not part:
+                continue
+            module, lst = part.split('(')
+            for alias in lst.split(','):
+                alias = alias.strip()
+                bus = alias.split(':', 1)[0]
+                result.setdefault(bus, {}).setdefault(alias, set()).add(name)
+    except ValueError:
+        logging.error('Package %s has invalid modalias header: %s' % (
+            name, modaliases))
+
+
+def _video_abi_verdict(apt_cache, name, record, video_abi_compat):
+    '''Check the video ABI of a package, and remember the verdict.'''
+
+    compatible = _check_video_abi_compat(apt_cache, record)
+    if video_abi_compat is not None:
+        video_abi_compat[name] = compatible
+    return compatible
+
+
+def _apt_cache_modalias_map(apt_cache, video_abi_compat=None):
     '''Build a modalias map from an apt.Cache object.
 
     This filters out uninstallable video drivers (i. e. which depend on a video
-    ABI that xserver-xorg-core does not provide).
+    ABI that xserver-xorg-core does not provide). If video_abi_compat is a
+    dictionary, the verdict for each package gets stored in it.
 
     Return a map bus -> modalias -> [package, ...], where "bus" is the prefix of
     the modalias up to the first ':' (e. g. "pci" or "usb").
     '''
     result = {}
+    raw = aptscan.raw_cache(apt_cache)
+    if raw is not None:
+        # only parse the candidate records which have a Modaliases field
+        for name, record in raw.candidate_records('Modaliases', ('all', system_architecture)):
+            # skip incompatible video drivers
+            if not _video_abi_verdict(apt_cache, name, record, video_abi_compat):
+                continue
+            _add_package_modaliases(result, name, record['Modaliases'])
+        return result
+
     for package in apt_cache:
         # skip packages without a modalias field
         try:
@@ -120,50 +434,187 @@ def _apt_cache_modalias_map(apt_cache):
             continue
 
         # skip incompatible video drivers
-        if not _check_video_abi_compat(apt_cache, package.candidate.record):
+        if not _video_abi_verdict(apt_cache, package.name, package.candidate.record, video_abi_compat):
             continue
 
-        try:
-            for part in m.split(')'):
-                part = part.strip(', ')
-                if not part:
-                    continue
-                module, lst = part.split('(')
-                for alias in lst.split(','):
-                    alias = alias.strip()
-                    bus = alias.split(':', 1)[0]
-                    result.setdefault(bus, {}).setdefault(alias, set()).add(package.name)
-        except ValueError:
-            logging.error('Package %s has invalid modalias header: %s' % (
-                package.name, m))
+        _add_package_modaliases(result, package.name, m)
 
     return result
 
 
-def packages_for_modalias(apt_cache, modalias):
-    '''Search packages which match the given modalias.
+def _segments_modalias_map(apt_cache, segment_records, video_abi_compat=None):
+    '''Build a modalias map from the modalias index segments.
 
-    Return a list of apt.Package objects.
+    This gives the same result as _apt_cache_modalias_map(), but only looks up
+    the packages which have a Modaliases header in any Packages list, instead of
+    iterating over the whole apt cache. The header is taken from the stanza of
+    the candidate version.
     '''
-    pkgs = set()
+    result = {}
+    for name, records in segment_records.items():
+        try:
+            candidate = apt_cache[name].candidate
+        except KeyError:
+            continue
+
+        # skip foreign architectures, we usually only want native
+        # driver packages
+        if not candidate or candidate.architecture not in ('all', system_architecture):
+            continue
+
+        for record in records:
+            if (record.get('Version') == candidate.version and
+                    record.get('Architecture') == candidate.architecture):
+                break
+        else:
+            # candidate from a source without Packages list
+            record = candidate.record
+        try:
+            m = record['Modaliases']
+        except (KeyError, UnicodeDecodeError):
+            continue
+
+        # skip incompatible video drivers
+        if not _video_abi_verdict(apt_cache, name, record, video_abi_compat):
+            continue
+
+        _add_package_modaliases(result, name, m)
+
+    return result
+
+
+def _apt_state_files(apt_cache):
+    '''Return the (lists directory, dpkg status file) of an apt cache.'''
 
-    apt_cache_hash = hash(apt_cache)
     try:
-        cache_map = packages_for_modalias.cache_maps[apt_cache_hash]
-    except KeyError:
-        cache_map = _apt_cache_modalias_map(apt_cache)
-        packages_for_modalias.cache_maps[apt_cache_hash] = cache_map
+        return (apt_cache.lists_dir, apt_cache.status_file)
+    except AttributeError:
+        return (apt.apt_pkg.config.find_dir('Dir::State::Lists'),
+                apt.apt_pkg.config.find_file('Dir::State::status'))
+
+
+def _load_modalias_map(apt_cache):
+    '''Get the modalias map for an apt.Cache object.
+
+    This uses the index in /var/lib/ubuntu-drivers-common/ (or
+    $UBUNTU_DRIVERS_CACHE_DIR) if the apt lists and package cache did not change
+    since it was written, so that the whole apt cache does not need to be
+    iterated. Otherwise the map gets built from the index segments of the
+    Packages lists, which only get parsed again if they changed, and the index
+    is updated. Without any Packages lists, it falls back to
+    _apt_cache_modalias_map().
+
+    Return (modalias map, video ABI verdicts), where the verdicts map the
+    name of each package with a Modaliases header to whether it is compatible
+    with the current X.org video ABI.
+    '''
+    (lists_dir, status_file) = _apt_state_files(apt_cache)
+    # the candidates of apt.Cache and PackageLists can differ
+    key = modaliasindex.apt_state_key(lists_dir, status_file, system_architecture, type(apt_cache).__name__)
+    index = modaliasindex.load(key)
+    if index is None:
+        video_abi_compat = {}
+        segment_records = modaliasindex.update_segments(lists_dir, status_file)
+        if segment_records is None:
+            modalias_map = _apt_cache_modalias_map(apt_cache, video_abi_compat)
+        else:
+            modalias_map = _segments_modalias_map(apt_cache, segment_records, video_abi_compat)
+        modaliasindex.save(key, modalias_map, video_abi_compat)
+        index = (modalias_map, video_abi_compat)
+    return index
+
+
+def update_modalias_index(apt_cache=None):
+    '''Bring the persistent modalias index up to date.
+
+    This is called by the apt hook after "apt update", so that the next
+    detection run can use the index right away. An index or segments written
+    in another MODALIAS_INDEX_FORMAT are rebuilt.
+
+    If you already have an apt.Cache() object or a DetectionSession, you should
+    pass it as an argument for efficiency. If not given, this function creates
+    a temporary one by itself.
+    '''
+    if not apt_cache:
+        apt_cache = apt.Cache()
+    _load_modalias_map(_get_apt_cache(apt_cache))
+
+
+def _modalias_matcher(apt_cache):
+    '''Get the ModaliasMatcher for an apt.Cache object.'''
+
+    return packages_for_modalias.cache_maps.get(apt_cache)[0]
+
+
+def _video_abi_verdicts(apt_cache):
+    '''Get the video ABI verdicts of the modalias index for an apt.Cache object.
+
+    This does not load or build the index; if there is no matcher for
+    apt_cache yet, this returns an empty map.
+    '''
+    entry = packages_for_modalias.cache_maps.peek(apt_cache)
+    if entry is None:
+        return {}
+    return entry[1]
+
+
+def _build_modalias_matcher(apt_cache):
+    (modalias_map, video_abi_compat) = _load_modalias_map(apt_cache)
+    return (ModaliasMatcher(modalias_map), video_abi_compat)
+
+
+def iter_packages_for_modaliases(apt_cache, modaliases):
+    '''Search packages which match any of the given modaliases.
+
+    modaliases can be any iterable (such as a generator); every distinct
+    modalias is matched once, as soon as it is produced, and every apt.Package
+    object is only looked up once for all of them.
+
+    Yield a (modalias, [apt.Package, ...]) pair for every distinct modalias, as
+    soon as it is matched.
+    '''
+    apt_cache = _get_apt_cache(apt_cache)
+    matcher = _modalias_matcher(apt_cache)
+    packages = {}
+    seen = set()
+    for modalias in modaliases:
+        if modalias in seen:
+            continue
+        seen.add(modalias)
+        pkgs = []
+        for name in matcher.match(modalias):
+            try:
+                pkg = packages[name]
+            except KeyError:
+                try:
+                    pkg = packages[name] = apt_cache[name]
+                except KeyError:
+                    logging.debug('packages_for_modaliases(): %s is not in the apt cache', name)
+                    continue
+            pkgs.append(pkg)
+        yield (modalias, pkgs)
+
+
+def packages_for_modaliases(apt_cache, modaliases):
+    '''Search packages which match any of the given modaliases.
+
+    This collects the results of iter_packages_for_modaliases().
+
+    Return a modalias → [apt.Package, ...] map.
+    '''
+    return dict(iter_packages_for_modaliases(apt_cache, modaliases))
 
-    bus_map = cache_map.get(modalias.split(':', 1)[0], {})
-    for alias in bus_map:
-        if fnmatch.fnmatch(modalias.lower(), alias.lower()):
-            for p in bus_map[alias]:
-                pkgs.add(p)
 
-    return [apt_cache[p] for p in pkgs]
+def packages_for_modalias(apt_cache, modalias):
+    '''Search packages which match the given modalias.
+
+    Return a list of apt.Package objects.
+    '''
+    return packages_for_modaliases(apt_cache, (modalias,))[modalias]
 
 
-packages_for_modalias.cache_maps = {}
+# matcher and video ABI verdicts for each apt.Cache
+packages_for_modalias.cache_maps = ModaliasMatcherCache(_build_modalias_matcher)
 
 
 def _is_package_free(pkg):
@@ -222,7 +673,31 @@ def _pkg_get_support(pkg):
     return support
 
 
-def _is_manual_install(pkg):
+def _package_metadata(apt_cache, pkg, field):
+    '''Get the free, from_distro, support or module field of an apt.Package.
+
+    These only depend on the candidate version, so each of them is computed
+    once for every package, and kept until the cache gets reopened.
+    '''
+    info = _package_metadata.memo.get(apt_cache).setdefault(pkg.name, {})
+    try:
+        return info[field]
+    except KeyError:
+        value = info[field] = _package_metadata.fields[field](pkg)
+        return value
+
+
+_package_metadata.fields = {
+    'free': _is_package_free,
+    'from_distro': _is_package_from_distro,
+    'support': _pkg_get_support,
+    'module': _pkg_get_module,
+}
+# package name → field → value for each apt.Cache
+_package_metadata.memo = aptscan.CacheMemo(lambda apt_cache: {})
+
+
+def _is_manual_install(pkg, apt_cache):
     '''Determine if the kernel module from an apt.Package is manually installed.'''
 
     if pkg.installed:
@@ -234,15 +709,19 @@ def _is_manual_install(pkg):
     elif pkg.name.startswith('fglrx'):
         module = 'fglrx'
     else:
-        module = _pkg_get_module(pkg)
+        module = _package_metadata(apt_cache, pkg, 'module')
 
     if not module:
         return False
 
-    modinfo = subprocess.Popen(['modinfo', module], stdout=subprocess.PIPE,
-                               stderr=subprocess.PIPE)
-    modinfo.communicate()
-    if modinfo.returncode == 0:
+    available = kmodindex.module_available(module)
+    if available is None:
+        # no module index for the running kernel, ask modinfo
+        modinfo = subprocess.Popen(['modinfo', module], stdout=subprocess.PIPE,
+                                   stderr=subprocess.PIPE)
+        modinfo.communicate()
+        available = modinfo.returncode == 0
+    if available:
         logging.debug('_is_manual_install %s: builds module %s which is available, manual install',
                       pkg.name, module)
         return True
@@ -252,24 +731,49 @@ def _is_manual_install(pkg):
     return False
 
 
-def _get_db_name(syspath, alias):
-    '''Return (vendor, model) names for given device.
+@functools.lru_cache(maxsize=None)
+def _udevadm_hwdb(alias):
+    '''Query "udevadm hwdb --test" for a modalias.
 
-    Values are None if unknown.
+    This is the fallback for systems without a readable hwdb.bin. udevadm only
+    takes one modalias at a time, so results are remembered for each modalias
+    to run it at most once for every distinct one.
+
+    Return a map property → value, or None if udevadm failed.
     '''
     try:
         out = subprocess.check_output(['udevadm', 'hwdb', '--test=' + alias],
                                       universal_newlines=True)
     except (OSError, subprocess.CalledProcessError) as e:
-        logging.debug('_get_db_name(%s, %s): udevadm hwdb failed: %s', syspath, alias, str(e))
-        return (None, None)
+        logging.debug('_udevadm_hwdb(%s): udevadm hwdb failed: %s', alias, str(e))
+        return None
 
-    logging.debug('_get_db_name: output\n%s\n', out)
+    logging.debug('_udevadm_hwdb: output\n%s\n', out)
 
-    vendor = None
-    model = None
+    properties = {}
     for line in out.splitlines():
         (k, v) = line.split('=', 1)
+        properties[k] = v
+    return properties
+
+
+def _get_db_name(syspath, alias):
+    '''Return (vendor, model) names for given device.
+
+    This looks up the modalias in the udev hwdb.bin, and falls back to
+    "udevadm hwdb" if that cannot be read.
+
+    Values are None if unknown.
+    '''
+    properties = hwdb.lookup(alias)
+    if properties is None:
+        properties = _udevadm_hwdb(alias)
+        if properties is None:
+            return (None, None)
+
+    vendor = None
+    model = None
+    for (k, v) in properties.items():
         if '_VENDOR' in k:
             vendor = v
         if '_MODEL' in k:
@@ -280,6 +784,158 @@ def _get_db_name(syspath, alias):
     return (vendor, model)
 
 
+def _with_names(info, names):
+    '''Add the known names of a (vendor, model) pair to the info dictionary and return it.'''
+
+    (vendor, model) = names
+    if vendor is not None:
+        info['vendor'] = vendor
+    if model is not None:
+        info['model'] = model
+    return info
+
+
+class DetectionSession(object):
+    '''State which is shared between detection calls.
+
+    A session lazily creates (or takes) one apt.Cache, and remembers the
+    modalias scan of the system and the vendor/model names of modaliases, so
+    that a sequence of calls only does each of these once. It can be passed
+    instead of the apt_cache argument to all public functions of this module.
+    The session assumes that the hardware does not change while it is in use.
+
+    Kernel detection results are kept with the apt cache (see
+    _kernel_results()), so they are shared by all sessions for it, and redone
+    when packages get marked.
+    '''
+
+    def __init__(self, apt_cache=None, sys_path=None):
+        self._apt_cache = apt_cache
+        self.sys_path = sys_path
+        self._devices = None
+        self._modaliases = None
+        self._kernel_detection = None
+        self._db_names = {}
+
+    @property
+    def apt_cache(self):
+        '''The apt.Cache object of this session.'''
+
+        if self._apt_cache is None:
+            self._apt_cache = apt.Cache()
+        return self._apt_cache
+
+    def iter_modaliases(self):
+        '''Iterate over the (modalias, sysfs path) pairs of the system.
+
+        The first complete iteration scans sysfs with iter_system_modaliases(),
+        later ones use its result.
+        '''
+        if self._devices is not None:
+            return iter(self._devices)
+        return self._scan_modaliases()
+
+    def _scan_modaliases(self):
+        devices = []
+        for device in iter_system_modaliases(self.sys_path):
+            devices.append(device)
+            yield device
+        self._devices = devices
+
+    def modaliases(self):
+        '''Return the modalias → sysfs path map, like system_modaliases().'''
+
+        if self._modaliases is None:
+            self._modaliases = dict(self.iter_modaliases())
+        return self._modaliases
+
+    def db_name(self, syspath, alias):
+        '''Return the (vendor, model) names of a modalias, like _get_db_name().'''
+
+        try:
+            return self._db_names[alias]
+        except KeyError:
+            names = self._db_names[alias] = _get_db_name(syspath, alias)
+            return names
+
+    @property
+    def kernel_detection(self):
+        '''The KernelDetection object for the apt cache of this session.'''
+
+        if self._kernel_detection is None:
+            self._kernel_detection = kerneldetection.KernelDetection(self.apt_cache)
+        return self._kernel_detection
+
+    def _kernel_result(self, name, fn, *args):
+        results = _kernel_results(self.apt_cache)
+        try:
+            return results[name]
+        except KeyError:
+            result = results[name] = fn(*args)
+            return result
+
+    def linux_headers(self):
+        '''Return the linux headers metapackage for the system's kernel.'''
+
+        return self._kernel_result('headers', self.kernel_detection.get_linux_headers_metapackage)
+
+    def linux_image(self):
+        '''Return the linux image metapackage for the system's kernel.'''
+
+        return self._kernel_result('image', self.kernel_detection.get_linux_image_metapackage)
+
+    def linux_version(self):
+        '''Return the ABI version of the system's kernel.'''
+
+        return self._kernel_result('version', self.kernel_detection.get_linux_version, self.linux_image())
+
+    def linux(self):
+        '''Return the linux metapackage for the system's kernel.'''
+
+        return self._kernel_result('meta', self.kernel_detection.get_linux_metapackage)
+
+    def linux_image_package(self):
+        '''Return the linux-image package of the system's linux image metapackage.'''
+
+        return self._kernel_result('image_package', get_linux_image_from_meta, self.apt_cache,
+                                   self.linux_image())
+
+
+def _kernel_results(apt_cache):
+    '''Return the kernel detection results of an apt cache.
+
+    This is a map which DetectionSession fills, and which is kept for the
+    apt cache until its generation changes, i. e. until packages get
+    (un)marked or the cache gets reopened.
+    '''
+    return _kernel_results.memo.get(apt_cache)
+
+
+_kernel_results.memo = aptscan.CacheMemo(lambda apt_cache: {}, generation=True)
+
+
+def _get_session(apt_cache=None, sys_path=None):
+    '''Return a DetectionSession for an apt_cache argument.
+
+    apt_cache can be a DetectionSession, an apt.Cache object, or None. A new
+    session is created unless a session for the same sys_path is given; a
+    session for another sys_path shares the apt cache of the given one.
+    '''
+    if isinstance(apt_cache, DetectionSession):
+        if sys_path is None or sys_path == apt_cache.sys_path:
+            return apt_cache
+        return DetectionSession(apt_cache.apt_cache, sys_path)
+    return DetectionSession(apt_cache, sys_path)
+
+
+def _get_apt_cache(apt_cache):
+    '''Return the apt cache of an apt_cache argument which may be a DetectionSession.'''
+
+    if isinstance(apt_cache, DetectionSession):
+        return apt_cache.apt_cache
+    return apt_cache
+
+
 def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, include_oem=True):
     '''Get driver packages that are available for the system.
 
@@ -287,9 +943,9 @@ def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, includ
     queries apt about which packages provide drivers for those. It also adds
     available packages from detect_plugin_packages().
 
-    If you already have an apt.Cache() object, you should pass it as an
-    argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    If you already have an apt.Cache() object or a DetectionSession, you should
+    pass it as an argument for efficiency. If not given, this function creates
+    a temporary one by itself.
 
     If freeonly is set to True, only free packages (from main and universe) are
     considered
@@ -315,31 +971,67 @@ def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, includ
       'recommended': Some drivers (nvidia, fglrx) come in multiple variants and
                      versions; these have this flag, where exactly one has
                      recommended == True, and all others False.
+      'syspaths':    sysfs directories of all devices which have the modalias
+                     (not for drivers from detect plugins)
     '''
-    modaliases = system_modaliases(sys_path)
+    session = _get_session(apt_cache, sys_path)
+    return _driver_packages(session, session.iter_modaliases(), freeonly, include_oem)[0]
 
-    if not apt_cache:
-        apt_cache = apt.Cache()
 
+def _driver_packages(session, devices, freeonly=False, include_oem=True):
+    '''Get driver packages for an iterable of (modalias, sysfs path) pairs.
+
+    This does the work of system_driver_packages(), consuming
+    iter_system_modaliases() while it scans. Packages are only matched once
+    for every distinct modalias, no matter how many devices share it.
+
+    Return a (packages, alias_info) pair, where packages is the
+    system_driver_packages() result and alias_info maps each modalias with
+    drivers to {'drivers': [package name, ...], 'syspaths': [sysfs path, ...],
+    'vendor': ..., 'model': ...}.
+    '''
+    apt_cache = session.apt_cache
     packages = {}
-    for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
-            if freeonly and not _is_package_free(p):
+    alias_info = {}
+    seen = {}
+
+    def new_aliases():
+        for alias, syspath in devices:
+            if alias in seen:
+                seen[alias].append(syspath)
+            else:
+                seen[alias] = [syspath]
+                yield alias
+
+    for alias, pkgs in iter_packages_for_modaliases(apt_cache, new_aliases()):
+        if not pkgs:
+            continue
+
+        syspaths = seen[alias]
+        names = session.db_name(syspaths[0], alias)
+        info = _with_names({'drivers': [], 'syspaths': syspaths}, names)
+
+        for p in pkgs:
+            if freeonly and not _package_metadata(apt_cache, p, 'free'):
                 continue
             if not include_oem and fnmatch.fnmatch(p.name, 'oem-*-meta'):
                 continue
-            packages[p.name] = {
+            packages[p.name] = _with_names({
                     'modalias': alias,
-                    'syspath': syspath,
-                    'free': _is_package_free(p),
-                    'from_distro': _is_package_from_distro(p),
-                    'support': _pkg_get_support(p),
-                }
-            (vendor, model) = _get_db_name(syspath, alias)
-            if vendor is not None:
-                packages[p.name]['vendor'] = vendor
-            if model is not None:
-                packages[p.name]['model'] = model
+                    'syspaths': syspaths,
+                    'free': _package_metadata(apt_cache, p, 'free'),
+                    'from_distro': _package_metadata(apt_cache, p, 'from_distro'),
+                    'support': _package_metadata(apt_cache, p, 'support'),
+                }, names)
+            info['drivers'].append(p.name)
+
+        if info['drivers']:
+            alias_info[alias] = info
+
+    # further devices with the same modalias can come after the match
+    for pkginfo in packages.values():
+        pkginfo['syspaths'] = list(pkginfo['syspaths'])
+        pkginfo['syspath'] = pkginfo['syspaths'][-1]
 
     # Add "recommended" flags for NVidia alternatives
     nvidia_packages = [p for p in packages if p.startswith('nvidia-')]
@@ -358,16 +1050,16 @@ def system_driver_packages(apt_cache=None, sys_path=None, freeonly=False, includ
             packages[p]['recommended'] = (p == recommended)
 
     # add available packages which need custom detection code
-    for plugin, pkgs in detect_plugin_packages(apt_cache).items():
+    for plugin, pkgs in detect_plugin_packages(session).items():
         for p in pkgs:
             apt_p = apt_cache[p]
             packages[p] = {
-                    'free': _is_package_free(apt_p),
-                    'from_distro': _is_package_from_distro(apt_p),
+                    'free': _package_metadata(apt_cache, apt_p, 'free'),
+                    'from_distro': _package_metadata(apt_cache, apt_p, 'from_distro'),
                     'plugin': plugin,
                 }
 
-    return packages
+    return (packages, alias_info)
 
 
 def _get_vendor_model_from_alias(alias):
@@ -426,9 +1118,9 @@ def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_o
     queries apt about which packages provide hardware enablement support for
     those.
 
-    If you already have an apt.Cache() object, you should pass it as an
-    argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    If you already have an apt.Cache() object or a DetectionSession, you should
+    pass it as an argument for efficiency. If not given, this function creates
+    a temporary one by itself.
 
     Return a dictionary which maps package names to information about them:
 
@@ -454,23 +1146,29 @@ def system_device_specific_metapackages(apt_cache=None, sys_path=None, include_o
     if not include_oem:
         return {}
 
-    modaliases = system_modaliases(sys_path)
-
-    if not apt_cache:
-        apt_cache = apt.Cache()
+    session = _get_session(apt_cache, sys_path)
+    apt_cache = session.apt_cache
 
     packages = {}
-    for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
+    syspaths = {}
+
+    def new_aliases():
+        for alias, syspath in session.iter_modaliases():
+            if alias not in syspaths:
+                syspaths[alias] = syspath
+                yield alias
+
+    for alias, pkgs in iter_packages_for_modaliases(apt_cache, new_aliases()):
+        for p in pkgs:
             if not fnmatch.fnmatch(p.name, 'oem-*-meta'):
                 continue
             packages[p.name] = {
                     'modalias': alias,
-                    'syspath': syspath,
-                    'free': _is_package_free(p),
-                    'from_distro': _is_package_from_distro(p),
+                    'syspath': syspaths[alias],
+                    'free': _package_metadata(apt_cache, p, 'free'),
+                    'from_distro': _package_metadata(apt_cache, p, 'from_distro'),
                     'recommended': True,
-                    'support': _pkg_get_support(p),
+                    'support': _package_metadata(apt_cache, p, 'support'),
                 }
 
     return packages
@@ -483,9 +1181,9 @@ def system_gpgpu_driver_packages(apt_cache=None, sys_path=None):
     queries apt about which packages provide drivers for those. Finally, it looks
     for the correct metapackage, by calling _get_headless_no_dkms_metapackage().
 
-    If you already have an apt.Cache() object, you should pass it as an
-    argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    If you already have an apt.Cache() object or a DetectionSession, you should
+    pass it as an argument for efficiency. If not given, this function creates
+    a temporary one by itself.
 
     Return a dictionary which maps package names to information about them:
 
@@ -510,28 +1208,23 @@ def system_gpgpu_driver_packages(apt_cache=None, sys_path=None):
                      recommended == True, and all others False.
     '''
     vendors_whitelist = ['10de']
-    modaliases = system_modaliases(sys_path)
-
-    if not apt_cache:
-        apt_cache = apt.Cache()
+    session = _get_session(apt_cache, sys_path)
+    modaliases = session.modaliases()
+    apt_cache = session.apt_cache
 
     packages = {}
-    for alias, syspath in modaliases.items():
-        for p in packages_for_modalias(apt_cache, alias):
-            (vendor, model) = _get_db_name(syspath, alias)
+    for alias, pkgs in iter_packages_for_modaliases(apt_cache, modaliases):
+        syspath = modaliases[alias]
+        for p in pkgs:
             vendor_id, model_id = _get_vendor_model_from_alias(alias)
             if (vendor_id is not None) and (vendor_id.lower() in vendors_whitelist):
-                packages[p.name] = {
+                packages[p.name] = _with_names({
                         'modalias': alias,
                         'syspath': syspath,
-                        'free': _is_package_free(p),
-                        'from_distro': _is_package_from_distro(p),
-                        'support': _pkg_get_support(p),
-                    }
-                if vendor is not None:
-                    packages[p.name]['vendor'] = vendor
-                if model is not None:
-                    packages[p.name]['model'] = model
+                        'free': _package_metadata(apt_cache, p, 'free'),
+                        'from_distro': _package_metadata(apt_cache, p, 'from_distro'),
+                        'support': _package_metadata(apt_cache, p, 'support'),
+                    }, session.db_name(syspath, alias))
                 metapackage = _get_headless_no_dkms_metapackage(p, apt_cache)
 
                 if metapackage is not None:
@@ -556,9 +1249,9 @@ def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
     adds available packages from detect_plugin_packages(), using the name of
     the detction plugin as device name.
 
-    If you already have an apt.Cache() object, you should pass it as an
-    argument for efficiency. If not given, this function creates a temporary
-    one by itself.
+    If you already have an apt.Cache() object or a DetectionSession, you should
+    pass it as an argument for efficiency. If not given, this function creates
+    a temporary one by itself.
 
     If freeonly is set to True, only free packages (from main and universe) are
     considered
@@ -602,30 +1295,46 @@ def system_device_drivers(apt_cache=None, sys_path=None, freeonly=False):
                      recommended == True, and all others False.
     '''
     result = {}
-    if not apt_cache:
-        apt_cache = apt.Cache()
+    session = _get_session(apt_cache, sys_path)
+    apt_cache = session.apt_cache
 
-    # copy the system_driver_packages() structure into the by-device structure
-    for pkg, pkginfo in system_driver_packages(apt_cache, sys_path,
-                                               freeonly=freeonly).items():
-        if 'syspath' in pkginfo:
-            device_name = pkginfo['syspath']
-        else:
-            device_name = pkginfo['plugin']
-        result.setdefault(device_name, {})
-        for opt_key in ('modalias', 'vendor', 'model'):
-            if opt_key in pkginfo:
-                result[device_name][opt_key] = pkginfo[opt_key]
-        drivers = result[device_name].setdefault('drivers', {})
+    packages, alias_info = _driver_packages(session, session.iter_modaliases(), freeonly=freeonly)
+
+    # fan out the per-modalias drivers to all devices which have the modalias
+    for alias, info in alias_info.items():
+        drivers = {}
+        for pkg in info['drivers']:
+            pkginfo = packages[pkg]
+            if 'plugin' in pkginfo:
+                continue
+            drivers[pkg] = {'free': pkginfo['free'], 'from_distro': pkginfo['from_distro']}
+            if 'recommended' in pkginfo:
+                drivers[pkg]['recommended'] = pkginfo['recommended']
+        if not drivers:
+            continue
+
+        for syspath in info['syspaths']:
+            device = result.setdefault(syspath, {'modalias': alias})
+            for opt_key in ('vendor', 'model'):
+                if opt_key in info:
+                    device[opt_key] = info[opt_key]
+            device.setdefault('drivers', {}).update(copy.deepcopy(drivers))
+
+    # drivers from detect plugins use the plugin name as device name
+    for pkg, pkginfo in packages.items():
+        if 'plugin' not in pkginfo:
+            continue
+        drivers = result.setdefault(pkginfo['plugin'], {}).setdefault('drivers', {})
         drivers[pkg] = {'free': pkginfo['free'], 'from_distro': pkginfo['from_distro']}
-        if 'recommended' in pkginfo:
-            drivers[pkg]['recommended'] = pkginfo['recommended']
 
     # now determine the manual_install device flag: this is true iff all driver
     # packages are "manually installed"
+    manual_install = {}
     for driver, info in result.items():
         for pkg in info['drivers']:
-            if not _is_manual_install(apt_cache[pkg]):
+            if pkg not in manual_install:
+                manual_install[pkg] = _is_manual_install(apt_cache[pkg], apt_cache)
+            if not manual_install[pkg]:
                 break
         else:
             info['manual_install'] = True
@@ -813,8 +1522,8 @@ def detect_plugin_packages(apt_cache=None):
     returned lists for packages which are available for installation, and
     return the joined results.
 
-    If you already have an existing apt.Cache() object, you can pass it as an
-    argument for efficiency.
+    If you already have an existing apt.Cache() object or a DetectionSession,
+    you can pass it as an argument for efficiency.
 
     Return pluginname -> [package, ...] map.
     '''
@@ -827,6 +1536,8 @@ def detect_plugin_packages(apt_cache=None):
 
     if apt_cache is None:
         apt_cache = apt.Cache()
+    apt_cache = _get_apt_cache(apt_cache)
+    video_abi_compat = _video_abi_verdicts(apt_cache)
 
     for fname in os.listdir(plugindir):
         if not fname.endswith('.py'):
@@ -852,7 +1563,10 @@ def detect_plugin_packages(apt_cache=None):
 
             for pkg in result:
                 if pkg in apt_cache and apt_cache[pkg].candidate:
-                    if _check_video_abi_compat(apt_cache, apt_cache[pkg].candidate.record):
+                    compatible = video_abi_compat.get(pkg)
+                    if compatible is None:
+                        compatible = _check_video_abi_compat(apt_cache, apt_cache[pkg].candidate.record)
+                    if compatible:
                         packages.setdefault(fname, []).append(pkg)
                 else:
                     logging.debug('Ignoring unavailable package %s from plugin %s', pkg, plugin)
@@ -942,51 +1656,34 @@ def _add_builtins(drivers):
 
 def get_linux_headers(apt_cache):
     '''Return the linux headers for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_headers_metapackage()
+    return _get_session(apt_cache).linux_headers()
 
 
 def get_linux_image(apt_cache):
     '''Return the linux image for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_image_metapackage()
+    return _get_session(apt_cache).linux_image()
 
 
 def get_linux_version(apt_cache):
     '''Return the linux image for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_version()
+    return _get_session(apt_cache).linux_version()
 
 
 def get_linux(apt_cache):
     '''Return the linux metapackage for the system's kernel'''
-    kernel_detection = kerneldetection.KernelDetection(apt_cache)
-    return kernel_detection.get_linux_metapackage()
+    return _get_session(apt_cache).linux()
 
 
 def find_reverse_dependencies(apt_cache, package, prefix):
     '''Return the reverse dependencies for a package'''
     # prefix to restrict the searching
     # package we want reverse dependencies for
-    deps = set()
-    for pkg in apt_cache:
-        if pkg.name.startswith(prefix):
-            dependencies = []
-            if pkg.candidate:
-                dependencies.extend(pkg.candidate.dependencies)
-            if pkg.installed:
-                dependencies.extend(pkg.installed.dependencies)
-
-            for ordep in dependencies:
-                for dep in ordep:
-                    if dep.rawtype != 'Depends':
-                        continue
-                    if dep.name == package:
-                        deps.add(pkg.name)
-    return list(deps)
+    apt_cache = _get_apt_cache(apt_cache)
+    return [name for name in aptscan.reverse_depends(apt_cache, package) if name.startswith(prefix)]
 
 
 def get_linux_image_from_meta(apt_cache, pkg):
+    apt_cache = _get_apt_cache(apt_cache)
     if apt_cache[pkg].candidate:
         record = apt_cache[pkg].candidate.record
 
@@ -1004,89 +1701,188 @@ def get_linux_image_from_meta(apt_cache, pkg):
 
 
 def get_linux_modules_metapackage(apt_cache, candidate):
-    '''Return the linux-modules-$driver metapackage for the system's kernel'''
+    '''Return the linux-modules-$driver metapackage for the system's kernel
+
+    This is the linux-modules-nvidia metapackage which depends on the modules
+    for the ABI of the kernel that the system's linux image metapackage
+    depends on. Unlike get_linux_modules_for_kernels(), this never returns the
+    ABI specific modules package itself, as that would not follow kernel
+    updates; without a metapackage this falls back to the nvidia-dkms package.
+    '''
     assert candidate is not None
-    metapackage = None
-    linux_flavour = ''
-    linux_modules_match = ''
 
-    if 'nvidia' not in candidate:
-        logging.debug('Non NVIDIA linux-modules packages are not supported at this time: %s. Skipping', candidate)
-        return metapackage
+    series = _nvidia_series(candidate)
+    if series is None:
+        return None
 
-    pattern = re.compile('nvidia-([0-9]+)')
-    match = pattern.match(candidate)
-    if match:
-        logging.debug('Legacy driver detected: %s. Skipping.', candidate)
-        return metapackage
+    session = _get_session(apt_cache)
+    apt_cache = session.apt_cache
 
-    linux_image_meta = get_linux_image(apt_cache)
     # Check the actual image package, and find the flavour from there
-    linux_image = get_linux_image_from_meta(apt_cache, linux_image_meta)
-
-    if linux_image:
-        linux_flavour = linux_image.replace('linux-image-', '')
-    else:
+    linux_image = session.linux_image_package()
+    if not linux_image:
         logging.debug('No linux-image can be found for %s. Skipping.', candidate)
-        return metapackage
+        return None
+
+    return _linux_modules_package(apt_cache, linux_modules_index(apt_cache), series,
+                                  kerneldetection.parse_image(linux_image), False, {})
+
+
+def get_linux_modules_metapackages(apt_cache, candidates):
+    '''Return the linux-modules-$driver metapackages for several driver packages
+
+    This is like calling get_linux_modules_metapackage() for each candidate,
+    but resolves the system's kernel only once for all of them.
+
+    Return a map candidate → metapackage (or None). Candidates for which the
+    lookup fails with a KeyError (e. g. as there is no linux image) are left
+    out.
+    '''
+    session = _get_session(apt_cache)
+    metapackages = {}
+    for candidate in candidates:
+        try:
+            metapackages[candidate] = get_linux_modules_metapackage(session, candidate)
+        except KeyError as e:
+            logging.debug('get_linux_modules_metapackages: cannot resolve %s: %s', candidate, str(e))
+    return metapackages
+
+
+# linux-modules-nvidia-<driver series>-<kernel version>-<ABI>-<flavour>
+_linux_modules_abi_re = re.compile(r'linux-modules-nvidia-(.+?)-([0-9][^-]*-[0-9]+)-(.+)$')
+
 
-    pattern = re.compile('nvidia-.*-([0-9]+)(.*)')
-    match = pattern.match(candidate)
+class LinuxModulesIndex(object):
+    '''The ABI specific linux-modules-nvidia packages of a list of package names.
+
+    These are named linux-modules-nvidia-<series>-<version>-<ABI>-<flavour>,
+    e. g. linux-modules-nvidia-440-server-5.4.0-26-generic. They are indexed
+    by (driver series, kernel flavour, kernel version), where the version is
+    "<version>-<ABI>" like the version of the kerneldetection.LinuxImage.
+    '''
+
+    def __init__(self, names):
+        self._packages = {}
+        for name in names:
+            match = _linux_modules_abi_re.match(name)
+            if match:
+                self._packages[(match.group(1), match.group(3), match.group(2))] = name
+
+    def package(self, series, flavour, version):
+        '''Return the modules package for a driver series and kernel, or None.'''
+
+        return self._packages.get((series, flavour, version))
+
+    def __len__(self):
+        return len(self._packages)
+
+
+def linux_modules_index(apt_cache):
+    '''Get the LinuxModulesIndex of an apt.Cache (or PackageLists) object or DetectionSession.
+
+    This is built once, and shared until the cache gets reopened.
+    '''
+    return linux_modules_index.memo.get(_get_apt_cache(apt_cache))
+
+
+linux_modules_index.memo = aptscan.CacheMemo(
+    lambda apt_cache: LinuxModulesIndex(aptscan.prefix_index(apt_cache).names('linux-modules-nvidia-')))
+
+
+def _nvidia_series(candidate):
+    '''Return the driver series (e. g. "440-server") of an nvidia driver package, or None.'''
+
+    if 'nvidia' not in candidate:
+        logging.debug('Non NVIDIA linux-modules packages are not supported at this time: %s. Skipping', candidate)
+        return None
+    if re.match('nvidia-([0-9]+)', candidate):
+        logging.debug('Legacy driver detected: %s. Skipping.', candidate)
+        return None
+    match = re.match('nvidia-.*-([0-9]+)(.*)', candidate)
     if not match:
         logging.debug('No flavour can be found in %s. Skipping.', candidate)
-        return metapackage
+        return None
+    return '%s%s' % (match.group(1), match.group(2))
 
-    candidate_flavour = '%s%s' % (match.group(1), match.group(2))
-    linux_modules_candidate = 'linux-modules-nvidia-%s-%s' % (candidate_flavour, linux_flavour)
 
+def _has_native_candidate(apt_cache, name):
     try:
-        package = apt_cache.__getitem__(linux_modules_candidate)
-        # skip foreign architectures, we usually only want native
-        if (package.candidate and
-                package.candidate.architecture in ('all', system_architecture)):
-            linux_version = get_linux_version(apt_cache)
-            linux_modules_abi_candidate = 'linux-modules-nvidia-%s-%s' % (candidate_flavour, linux_version)
-            logging.debug('linux_modules_abi_candidate: %s' % (linux_modules_abi_candidate))
-
-            # Let's check if there is a candidate that is specific to
-            # our kernel ABI. If not, things will fail.
-            abi_specific = apt_cache.__getitem__(linux_modules_abi_candidate)
-            # skip foreign architectures, we usually only want native
-            if (abi_specific.candidate and
-                    abi_specific.candidate.architecture in ('all', system_architecture)):
-                logging.debug('Found ABI compatible %s' % (linux_modules_abi_candidate))
-                linux_modules_match = linux_modules_candidate
+        package = apt_cache[name]
     except KeyError:
-        logging.debug('No "%s" can be found.', linux_modules_candidate)
-        pass
+        return False
+    # skip foreign architectures, we usually only want native
+    return bool(package.candidate and package.candidate.architecture in ('all', system_architecture))
 
-    # Add an extra layer of paranoia, and check the availability
-    # of modules with the correct ABI
-    if linux_modules_match:
-        # Look for the metapackage in the reverse
-        # dependencies
-        reverse_deps = find_reverse_dependencies(apt_cache, linux_modules_match, 'linux-modules-nvidia-')
+
+def _linux_modules_package(apt_cache, index, series, image, abi_fallback, dkms):
+    '''Return the linux-modules package of a driver series for a LinuxImage.
+
+    This is the newest linux-modules-nvidia metapackage which depends on the
+    modules for the ABI of image (which may be None). If there is none, this is
+    the ABI specific package itself with abi_fallback; without it, or if there
+    are no modules for the ABI at all, this is the nvidia-dkms package of the
+    series, or None. dkms keeps the results of the nvidia-dkms lookups.
+    '''
+    abi_package = image and index.package(series, image.flavour, image.version)
+    if abi_package and _has_native_candidate(apt_cache, abi_package):
+        logging.debug('Found ABI compatible %s', abi_package)
         pick = ''
-        for dep in reverse_deps:
+        for dep in find_reverse_dependencies(apt_cache, abi_package, 'linux-modules-nvidia-'):
             if dep > pick:
                 pick = dep
-        if pick:
-            metapackage = pick
-            return metapackage
+        if pick or abi_fallback:
+            return pick or abi_package
 
-    # If no linux-modules-nvidia package is available for the current kernel
+    # If no linux-modules-nvidia package is available for the kernel
     # we should install the relevant DKMS package
-    dkms_package = 'nvidia-dkms-%s' % candidate_flavour
-    logging.debug('Falling back to %s' % (dkms_package))
-
     try:
-        package = apt_cache.__getitem__(dkms_package)
-        # skip foreign architectures, we usually only want native
-        if (package.candidate and
-                package.candidate.architecture in ('all', system_architecture)):
-            metapackage = dkms_package
+        return dkms[series]
     except KeyError:
-        logging.error('No "%s" can be found.', dkms_package)
-        pass
+        dkms_package = 'nvidia-dkms-%s' % series
+        logging.debug('Falling back to %s', dkms_package)
+        if not _has_native_candidate(apt_cache, dkms_package):
+            logging.error('No "%s" can be found.', dkms_package)
+            dkms_package = None
+        dkms[series] = dkms_package
+        return dkms_package
+
+
+def get_linux_modules_for_kernels(apt_cache, candidates, kernels=None):
+    '''Return the linux-modules-$driver packages for several kernels
+
+    This resolves the kernel modules for each driver package in candidates for
+    every installed (or marked) linux image, or for the linux-image package
+    names in kernels. For each kernel this is the linux-modules-nvidia
+    metapackage which depends on the modules for its ABI, or these modules
+    themselves if there is no such metapackage (e. g. for an older kernel
+    which is kept installed). If there are no modules for the ABI, this falls
+    back to the nvidia-dkms package, like get_linux_modules_metapackage().
+
+    All lookups go through the kernel inventory and the LinuxModulesIndex of
+    the cache, which are built once.
+
+    Return a map linux-image package → {candidate → package (or None)}, with
+    the newest kernel first.
+    '''
+    session = _get_session(apt_cache)
+    apt_cache = session.apt_cache
 
-    return metapackage
+    if kernels is None:
+        images = session.kernel_detection.get_linux_images()
+    else:
+        inventory = dict((image.name, image) for image in kerneldetection.kernel_inventory(apt_cache).images)
+        images = [inventory[name] for name in kernels if name in inventory]
+
+    index = linux_modules_index(apt_cache)
+    series = dict((candidate, _nvidia_series(candidate)) for candidate in candidates)
+    dkms = {}
+
+    result = {}
+    for image in images:
+        modules = result[image.name] = {}
+        for candidate in candidates:
+            if series[candidate] is None:
+                modules[candidate] = None
+            else:
+                modules[candidate] = _linux_modules_package(apt_cache, index, series[candidate], image, True, dkms)
+    return result
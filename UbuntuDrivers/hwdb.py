@@ -0,0 +1,222 @@
+'''Reader for the binary udev hardware database (hwdb.bin).'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import mmap
+import struct
+import fnmatch
+import logging
+
+# where systemd looks for hwdb.bin, in this order
+HWDB_PATHS = ('/etc/systemd/hwdb/hwdb.bin',
+              '/etc/udev/hwdb.bin',
+              '/usr/lib/systemd/hwdb/hwdb.bin',
+              '/lib/systemd/hwdb/hwdb.bin',
+              '/usr/lib/udev/hwdb.bin',
+              '/lib/udev/hwdb.bin')
+
+_SIGNATURE = b'KSLPHHRH'
+# signature, tool_version, file_size, header_size, node_size,
+# child_entry_size, value_entry_size, nodes_root_off, nodes_len, strings_len
+_HEADER = struct.Struct('<8s9Q')
+# prefix_off, children_count, values_count
+_NODE = struct.Struct('<QB7xQ')
+# c, child_off
+_CHILD = struct.Struct('<B7xQ')
+# key_off, value_off
+_VALUE = struct.Struct('<QQ')
+# key_off, value_off, filename_off, line_number, file_priority
+_VALUE2 = struct.Struct('<QQQIH2x')
+
+_GLOB_CHARS = b'*?['
+
+
+class Hwdb(object):
+    '''A memory mapped hwdb.bin.
+
+    This is the trie which systemd-hwdb compiles from the hwdb.d/*.hwdb files,
+    and which "udevadm hwdb --test" and sd_hwdb_get() query. Lookups
+    follow sd-hwdb: literal characters walk down the trie, and the subtrees
+    after glob characters are matched with fnmatch.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (signature, _, file_size, header_size, self._node_size, self._child_size,
+             self._value_size, self._root, _, _) = _HEADER.unpack_from(self._map)
+        except struct.error:
+            signature = None
+        if (signature != _SIGNATURE or file_size != len(self._map) or header_size < _HEADER.size or
+                self._node_size < _NODE.size or self._child_size < _CHILD.size or
+                self._value_size < _VALUE.size):
+            self._map.close()
+            raise ValueError('%s is not a valid hwdb.bin' % path)
+        self._results = {}
+
+    def close(self):
+        self._map.close()
+
+    def _string(self, off):
+        return self._map[off:self._map.find(b'\0', off)]
+
+    def _child(self, node, children_count, c):
+        '''Binary search for the child node for character c.'''
+
+        base = node + self._node_size
+        lo = 0
+        hi = children_count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            (child_c, child_off) = _CHILD.unpack_from(self._map, base + mid * self._child_size)
+            if child_c < c:
+                lo = mid + 1
+            elif child_c > c:
+                hi = mid
+            else:
+                return child_off
+        return None
+
+    def _add_values(self, properties, node, children_count, values_count):
+        base = node + self._node_size + children_count * self._child_size
+        for n in range(values_count):
+            entry = base + n * self._value_size
+            if self._value_size >= _VALUE2.size:
+                (key_off, value_off, filename_off, line, priority) = _VALUE2.unpack_from(self._map, entry)
+            else:
+                (key_off, value_off) = _VALUE.unpack_from(self._map, entry)
+                filename_off = line = priority = 0
+
+            # properties start with a space; others are future extensions
+            key = self._string(key_off)
+            if not key.startswith(b' '):
+                continue
+            key = key[1:].decode('UTF-8', 'replace')
+
+            old = properties.get(key)
+            if old is not None and self._value_size >= _VALUE2.size:
+                # on duplicates, the ones from files with higher priority (or
+                # from later lines of the same file) win
+                (_, old_filename_off, old_line, old_priority) = old
+                if priority == 0:
+                    lower = (filename_off, line) < (old_filename_off, old_line)
+                else:
+                    lower = (priority, line) < (old_priority, old_line)
+                if lower:
+                    continue
+            properties[key] = (self._string(value_off).decode('UTF-8', 'replace'),
+                               filename_off, line, priority)
+
+    def _fnmatch(self, properties, node, p, pattern, search):
+        '''Add the values of all nodes below node whose pattern matches search.'''
+
+        (prefix_off, children_count, values_count) = _NODE.unpack_from(self._map, node)
+        prefix = self._string(prefix_off)[p:] if prefix_off else b''
+        pattern += prefix
+        for n in range(children_count):
+            (c, child) = _CHILD.unpack_from(self._map, node + self._node_size + n * self._child_size)
+            pattern.append(c)
+            self._fnmatch(properties, child, 0, pattern, search)
+            pattern.pop()
+
+        if values_count and fnmatch.fnmatchcase(search, bytes(pattern)):
+            self._add_values(properties, node, children_count, values_count)
+        del pattern[len(pattern) - len(prefix):]
+
+    def _search(self, search):
+        properties = {}
+        node = self._root
+        i = 0
+        while node:
+            (prefix_off, children_count, values_count) = _NODE.unpack_from(self._map, node)
+            if prefix_off:
+                prefix = self._string(prefix_off)
+                for p, c in enumerate(prefix):
+                    if c in _GLOB_CHARS:
+                        self._fnmatch(properties, node, p, bytearray(), search[i + p:])
+                        return properties
+                    if search[i + p:i + p + 1] != prefix[p:p + 1]:
+                        return properties
+                i += len(prefix)
+
+            for c in _GLOB_CHARS:
+                child = self._child(node, children_count, c)
+                if child:
+                    self._fnmatch(properties, child, 0, bytearray([c]), search[i:])
+
+            if i == len(search):
+                self._add_values(properties, node, children_count, values_count)
+                return properties
+
+            node = self._child(node, children_count, search[i])
+            i += 1
+        return properties
+
+    def get(self, modalias):
+        '''Look up a modalias.
+
+        Return a map property → value like "udevadm hwdb --test=modalias"
+        prints. Results are remembered for each modalias.
+        '''
+        try:
+            return self._results[modalias]
+        except KeyError:
+            properties = self._search(modalias.encode('UTF-8'))
+            result = self._results[modalias] = dict((k, v[0]) for k, v in properties.items())
+            return result
+
+
+def _file_state(path):
+    st = os.stat(path)
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+def get_hwdb():
+    '''Get the Hwdb of the system.
+
+    This opens the first hwdb.bin of HWDB_PATHS, and keeps it open until the
+    file gets replaced (e. g. by "systemd-hwdb update").
+
+    Return None if there is no usable hwdb.bin.
+    '''
+    for path in HWDB_PATHS:
+        try:
+            state = _file_state(path)
+        except OSError:
+            continue
+        if get_hwdb.current is not None:
+            (current_path, current_state, hwdb) = get_hwdb.current
+            if current_path == path and current_state == state:
+                return hwdb
+            hwdb.close()
+            get_hwdb.current = None
+        try:
+            hwdb = Hwdb(path)
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('Cannot read %s: %s', path, e)
+            return None
+        get_hwdb.current = (path, state, hwdb)
+        return hwdb
+    return None
+
+
+get_hwdb.current = None
+
+
+def lookup(modalias):
+    '''Look up a modalias in the hwdb.bin of the system.
+
+    Return a map property → value, or None if there is no usable hwdb.bin.
+    '''
+    hwdb = get_hwdb()
+    if hwdb is None:
+        return None
+    return hwdb.get(modalias)
@@ -21,10 +21,62 @@
 #       MA 02110-1301, USA.
 
 import apt
+import apt_pkg
+import collections
+import functools
 import logging
 import re
 
-from subprocess import Popen
+from UbuntuDrivers import aptscan
+
+# linux-image-[un]signed-<version>-<ABI>-<flavour>; the version starts with a
+# digit, which rules out metapackages like linux-image-generic-hwe-18.04
+_image_re = re.compile('linux-image-(?:(?:un)?signed-)?([0-9][^-]*)-([0-9]+)-(.+)$')
+
+LinuxImage = collections.namedtuple('LinuxImage', ['name', 'version', 'abi', 'flavour'])
+
+
+def parse_image(name):
+    '''Parse a linux-image package name into a LinuxImage, or return None.'''
+
+    match = _image_re.match(name)
+    if not match:
+        return None
+    return LinuxImage(name, '%s-%s' % (match.group(1), match.group(2)), match.group(2), match.group(3))
+
+
+def _compare_images(image1, image2):
+    return apt_pkg.version_compare(image1.version, image2.version)
+
+
+class KernelInventory(object):
+    '''The linux-image packages of a list of package names, newest first.
+
+    Every linux-image-<version>-<ABI>-<flavour> package (also the signed- and
+    unsigned- variants) is parsed once into a LinuxImage record, whose version
+    is "<version>-<ABI>". Images are sorted by apt_pkg.version_compare() on
+    these; images with the same version keep the order of their names.
+    '''
+
+    def __init__(self, names):
+        images = [image for image in map(parse_image, names) if image is not None]
+        # reverse=True keeps equal versions in their original order
+        self.images = sorted(images, key=functools.cmp_to_key(_compare_images), reverse=True)
+
+    def __len__(self):
+        return len(self.images)
+
+
+def kernel_inventory(apt_cache):
+    '''Get the KernelInventory of an apt.Cache (or PackageLists) object.
+
+    This is built once, and shared until the cache gets reopened.
+    '''
+    return kernel_inventory.memo.get(apt_cache)
+
+
+kernel_inventory.memo = aptscan.CacheMemo(
+    lambda apt_cache: KernelInventory(aptscan.prefix_index(apt_cache).names('linux-image')))
 
 
 class KernelDetection(object):
@@ -35,96 +87,66 @@ class KernelDetection(object):
         else:
             self.apt_cache = apt.Cache()
 
-    def _is_greater_than(self, term1, term2):
-        # We don't want to take into account
-        # the flavour
-        pattern = re.compile('(.+)-([0-9]+)-(.+)')
-        match1 = pattern.match(term1)
-        match2 = pattern.match(term2)
-        if match1:
-            term1 = '%s-%s' % (match1.group(1),
-                               match1.group(2))
-            term2 = '%s-%s' % (match2.group(1),
-                               match2.group(2))
-
-        logging.debug('Comparing %s with %s' % (term1, term2))
-        command = 'dpkg --compare-versions %s gt %s' % \
-                  (term1, term2)
-        process = Popen(command.split(' '))
-        process.communicate()
-        return not process.returncode
+    def _selected_images(self):
+        '''Get the LinuxImages which are installed or marked for installation, newest first
+
+        This keeps the precedence of "not extra and installed, or marked for
+        installation".
+        '''
+        raw = aptscan.raw_cache(self.apt_cache)
+        if raw is not None:
+            def selected(name):
+                pkg = raw.package(name)
+                return ('extra' not in name and raw.is_installed(pkg) or
+                        raw.marked_install(pkg))
+        else:
+            def selected(name):
+                pkg = self.apt_cache[name]
+                return ('extra' not in name and pkg.is_installed or
+                        pkg.marked_install)
+
+        return [image for image in kernel_inventory(self.apt_cache).images if selected(image.name)]
+
+    def get_linux_images(self):
+        '''Get the LinuxImages of all installed (or marked) kernels, newest first'''
+        return self._selected_images()
+
+    def _newest_image(self):
+        '''Get the LinuxImage of the newest installed (or marked) kernel, or None'''
+
+        for image in self._selected_images():
+            return image
+        return None
 
     def _find_reverse_dependencies(self, package, prefix):
         # prefix to restrict the searching
         # package we want reverse dependencies for
         deps = set()
-        for pkg in self.apt_cache:
-            if (pkg.name.startswith(prefix) and
-                    'extra' not in pkg.name and
+        for name in aptscan.reverse_depends(self.apt_cache, package):
+            pkg = self.apt_cache[name]
+            if (name.startswith(prefix) and
+                    'extra' not in name and
                     pkg.is_installed or
                     pkg.marked_install):
-
-                dependencies = []
-                if pkg.candidate:
-                    dependencies.extend(pkg.candidate.dependencies)
-                if pkg.installed:
-                    dependencies.extend(pkg.installed.dependencies)
-
-                for ordep in dependencies:
-                    for dep in ordep:
-                        if dep.rawtype != 'Depends':
-                            continue
-                        if dep.name == package:
-                            deps.add(pkg.name)
+                deps.add(name)
 
         return list(deps)
 
-    def _get_linux_flavour(self, candidates, image):
-        pattern = re.compile(r'linux-image-([0-9]+\.[0-9]+\.[0-9]+)-([0-9]+)-(.+)')
-        match = pattern.match(image)
-        flavour = ''
-        if match:
-            flavour = match.group(3)
-
-        return flavour
-
     def _get_linux_metapackage(self, target):
         '''Get the linux headers, linux-image or linux metapackage'''
         metapackage = ''
-        image_package = ''
-        version = ''
         prefix = 'linux-%s' % ('headers' if target == 'headers' else 'image')
 
-        pattern = re.compile('linux-image-(.+)-([0-9]+)-(.+)')
-
-        for pkg in self.apt_cache:
-            # We always start with "linux-image"
-            # since installing headers or metapackages
-            # for kernels that are not installed
-            # won't help
-            if (pkg.name.startswith('linux-image') and
-                    'extra' not in pkg.name and
-                    self.apt_cache[pkg.name].is_installed or
-                    self.apt_cache[pkg.name].marked_install):
-                match = pattern.match(pkg.name)
-                # Here we filter out packages other than
-                # the actual image or header packages
-                if match:
-                    current_package = match.group(0)
-                    current_version = '%s-%s' % (match.group(1),
-                                                 match.group(2))
-                    # See if the current version is greater than
-                    # the greatest that we've found so far
-                    if self._is_greater_than(current_version,
-                                             version):
-                        version = current_version
-                        image_package = current_package
-
-        if version:
+        # We always start with "linux-image"
+        # since installing headers or metapackages
+        # for kernels that are not installed
+        # won't help
+        image = self._newest_image()
+        if image:
             if target == 'headers':
-                target_package = image_package.replace('image', 'headers')
+                target_package = image.name.replace('image', 'headers')
             else:
-                target_package = image_package
+                target_package = image.name
             reverse_dependencies = self._find_reverse_dependencies(target_package, prefix)
             if reverse_dependencies:
                 # This should be something like linux-image-$flavour
@@ -140,7 +162,7 @@ class KernelDetection(object):
                     # Let's get the metapackage
                     reverse_dependencies = self._find_reverse_dependencies(metapackage, 'linux-')
                     if reverse_dependencies:
-                        flavour = self._get_linux_flavour(reverse_dependencies, target_package)
+                        flavour = image.flavour
                         linux_meta = ''
                         for meta in reverse_dependencies:
                             # For example linux-generic-hwe-20.04
@@ -167,8 +189,9 @@ class KernelDetection(object):
         '''Get the linux metapackage for the newest_kernel installed'''
         return self._get_linux_metapackage('meta')
 
-    def get_linux_version(self):
-        linux_image_meta = self.get_linux_image_metapackage()
+    def get_linux_version(self, linux_image_meta=None):
+        if linux_image_meta is None:
+            linux_image_meta = self.get_linux_image_metapackage()
         linux_version = ''
         try:
             dependencies = self.apt_cache[linux_image_meta].candidate.\
@@ -0,0 +1,418 @@
+'''Reader for the kmod module indexes (modules.dep.bin, modules.alias.bin).'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import re
+import mmap
+import struct
+import fnmatch
+import logging
+
+# where kmod reads modprobe configuration from, in this order
+MODPROBE_DIRS = ('/etc/modprobe.d',
+                 '/run/modprobe.d',
+                 '/usr/local/lib/modprobe.d',
+                 '/lib/modprobe.d',
+                 '/usr/lib/modprobe.d')
+
+_MAGIC = 0xB007F457
+_VERSION_MAJOR = 0x0002
+_NODE_PREFIX = 0x80000000
+_NODE_VALUES = 0x40000000
+_NODE_CHILDS = 0x20000000
+_NODE_MASK = 0x0FFFFFFF
+
+_U32 = struct.Struct('>I')
+_GLOB_CHARS = b'*?['
+
+_module_ext_re = re.compile(r'\.ko(\.(gz|xz|zst))?$')
+
+
+def _normalize(name):
+    '''Normalize a module name or alias like kmod: '-' becomes '_' outside of [...].'''
+
+    parts = re.split(r'(\[[^]]*\])', name)
+    return ''.join(p if p.startswith('[') else p.replace('-', '_') for p in parts)
+
+
+class Index(object):
+    '''A memory mapped binary kmod index, as written by depmod.
+
+    This is a trie with optional prefix strings, a child table and a list of
+    prioritized values in every node. All numbers are big endian.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            (magic, version, self._root) = struct.unpack_from('>III', self._map)
+        except struct.error:
+            magic = version = None
+        if magic != _MAGIC or version >> 16 != _VERSION_MAJOR:
+            self._map.close()
+            raise ValueError('%s is not a valid kmod index' % path)
+
+    def close(self):
+        self._map.close()
+
+    def _node(self, offset):
+        '''Read a node.
+
+        Return (prefix, first child char, last child char, position of the child
+        table, position of the values or None).
+        '''
+        pos = offset & _NODE_MASK
+        prefix = b''
+        if offset & _NODE_PREFIX:
+            end = self._map.find(b'\0', pos)
+            prefix = self._map[pos:end]
+            pos = end + 1
+        if offset & _NODE_CHILDS:
+            (first, last) = (self._map[pos], self._map[pos + 1])
+            pos += 2
+            children = pos
+            pos += 4 * (last - first + 1)
+        else:
+            (first, last, children) = (128, 127, pos)
+        return (prefix, first, last, children, pos if offset & _NODE_VALUES else None)
+
+    def _child(self, node, c):
+        (_, first, last, children, _) = node
+        if first <= c <= last:
+            offset = _U32.unpack_from(self._map, children + 4 * (c - first))[0]
+            if offset:
+                return offset
+        return None
+
+    def _values(self, node):
+        '''Return the (priority, value) pairs of a node.'''
+
+        pos = node[4]
+        if pos is None:
+            return []
+        (count,) = _U32.unpack_from(self._map, pos)
+        pos += 4
+        values = []
+        for i in range(count):
+            (priority,) = _U32.unpack_from(self._map, pos)
+            end = self._map.find(b'\0', pos + 4)
+            values.append((priority, self._map[pos + 4:end].decode('UTF-8', 'replace')))
+            pos = end + 1
+        return values
+
+    def lookup(self, key):
+        '''Return the first value for key, or None.'''
+
+        key = key.encode('UTF-8')
+        offset = self._root
+        i = 0
+        while offset:
+            node = self._node(offset)
+            prefix = node[0]
+            if key[i:i + len(prefix)] != prefix:
+                return None
+            i += len(prefix)
+            if i == len(key):
+                values = self._values(node)
+                return values[0][1] if values else None
+            offset = self._child(node, key[i])
+            i += 1
+        return None
+
+    def _search_all(self, node, j, pattern, key, result):
+        prefix = node[0][j:]
+        pattern += prefix
+        for c in range(node[1], node[2] + 1):
+            child = self._child(node, c)
+            if child:
+                pattern.append(c)
+                self._search_all(self._node(child), 0, pattern, key, result)
+                pattern.pop()
+        if node[4] is not None and fnmatch.fnmatchcase(key, bytes(pattern)):
+            result.extend(self._values(node))
+        del pattern[len(pattern) - len(prefix):]
+
+    def search(self, key):
+        '''Return the values of all patterns in the index which match key.
+
+        Values are sorted by priority, like kmod does for modules.alias.bin.
+        '''
+        key = key.encode('UTF-8')
+        result = []
+        offset = self._root
+        i = 0
+        while offset:
+            node = self._node(offset)
+            for j, c in enumerate(node[0]):
+                if c in _GLOB_CHARS:
+                    self._search_all(node, j, bytearray(), key[i + j:], result)
+                    return _by_priority(result)
+                if key[i + j:i + j + 1] != node[0][j:j + 1]:
+                    return _by_priority(result)
+            i += len(node[0])
+
+            for c in _GLOB_CHARS:
+                child = self._child(node, c)
+                if child:
+                    self._search_all(self._node(child), 0, bytearray([c]), key[i:], result)
+
+            if i == len(key):
+                result.extend(self._values(node))
+                return _by_priority(result)
+
+            offset = self._child(node, key[i])
+            i += 1
+        return _by_priority(result)
+
+
+def _by_priority(values):
+    return [v for (p, v) in sorted(values, key=lambda pv: pv[0])]
+
+
+class TextIndex(object):
+    '''A text module index (modules.dep, modules.alias, ...).
+
+    This provides the same lookups as Index, for module trees which do not
+    have the binary indexes.
+    '''
+
+    def __init__(self, entries):
+        self._entries = entries
+        self._keys = {}
+        for (key, value) in entries:
+            self._keys.setdefault(key, value)
+
+    def lookup(self, key):
+        return self._keys.get(key)
+
+    def search(self, key):
+        return [value for (pattern, value) in self._entries if fnmatch.fnmatchcase(key, pattern)]
+
+
+def _module_name(path):
+    return _normalize(_module_ext_re.sub('', os.path.basename(path)))
+
+
+def _read_modules_list(f):
+    '''Parse modules.dep or modules.builtin into (module name, line) pairs.'''
+
+    entries = []
+    for line in f:
+        line = line.strip()
+        if line:
+            entries.append((_module_name(line.split(':', 1)[0]), line))
+    return entries
+
+
+def _read_aliases(f):
+    '''Parse modules.alias or modules.symbols into (pattern, module name) pairs.'''
+
+    entries = []
+    for line in f:
+        fields = line.split()
+        if len(fields) >= 3 and fields[0] == 'alias':
+            entries.append((_normalize(fields[1]), fields[2]))
+    return entries
+
+
+class ModuleIndex(object):
+    '''Module lookups in a kernel module tree.
+
+    This answers the questions for which ubuntu-drivers used to call modinfo
+    and "modprobe --resolve-alias", in the same way as kmod: from the
+    modprobe.d configuration and the indexes which depmod writes into
+    /lib/modules/<kernel>/. Binary indexes are memory mapped; if a tree only
+    has the text files, these are read instead. Each index is only loaded once,
+    when it is first needed.
+    '''
+
+    # index name → (binary file, text file, text parser)
+    _files = {
+        'dep': ('modules.dep.bin', 'modules.dep', _read_modules_list),
+        'alias': ('modules.alias.bin', 'modules.alias', _read_aliases),
+        'symbols': ('modules.symbols.bin', 'modules.symbols', _read_aliases),
+        'builtin': ('modules.builtin.bin', 'modules.builtin', _read_modules_list),
+        'builtin.alias': ('modules.builtin.alias.bin', 'modules.builtin.alias', _read_aliases),
+    }
+
+    def __init__(self, directory, config_dirs=MODPROBE_DIRS):
+        self.directory = directory
+        self.config_dirs = config_dirs
+        self._indexes = {}
+        self._config = None
+
+    def close(self):
+        for index in self._indexes.values():
+            if isinstance(index, Index):
+                index.close()
+        self._indexes = {}
+
+    def index(self, name):
+        '''Get the Index or TextIndex for an index name, or None if it does not exist.'''
+
+        try:
+            return self._indexes[name]
+        except KeyError:
+            pass
+
+        (binary, text, parse) = self._files[name]
+        index = None
+        try:
+            index = Index(os.path.join(self.directory, binary))
+        except (IOError, OSError, ValueError) as e:
+            logging.debug('ModuleIndex: cannot use %s: %s', binary, e)
+            try:
+                with open(os.path.join(self.directory, text), encoding='UTF-8', errors='replace') as f:
+                    index = TextIndex(parse(f))
+            except (IOError, OSError) as e:
+                logging.debug('ModuleIndex: cannot use %s: %s', text, e)
+        self._indexes[name] = index
+        return index
+
+    def available(self):
+        '''Check whether the module tree has a modules.dep index.'''
+
+        return self.index('dep') is not None
+
+    def _read_config(self):
+        '''Read the alias, install and remove commands of the modprobe.d files.'''
+
+        # files in earlier directories override the ones with the same name
+        # in later directories; all of them are read sorted by name
+        files = {}
+        for d in self.config_dirs:
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for n in names:
+                if n.endswith('.conf'):
+                    files.setdefault(n, os.path.join(d, n))
+
+        aliases = []
+        commands = set()
+        for n in sorted(files):
+            try:
+                with open(files[n], encoding='UTF-8', errors='replace') as f:
+                    text = f.read().replace('\\\n', '')
+            except (IOError, OSError):
+                continue
+            for line in text.splitlines():
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if fields[0] == 'alias' and len(fields) >= 3:
+                    aliases.append((_normalize(fields[1]), _normalize(fields[2])))
+                elif fields[0] in ('install', 'remove') and len(fields) >= 2:
+                    commands.add(_normalize(fields[1]))
+        return (aliases, commands)
+
+    def _search(self, name, key, exact=False):
+        index = self.index(name)
+        if index is None:
+            return []
+        if exact:
+            value = index.lookup(key)
+            return [] if value is None else [key]
+        return index.search(key)
+
+    def lookup(self, alias):
+        '''Get the modules for a module name or alias.
+
+        Like kmod_module_new_from_lookup(), this tries the modprobe.d aliases,
+        the module names, symbols, install/remove commands, modules.alias and
+        the builtin modules and aliases, in that order, and stops at the first
+        of these which has any match.
+
+        Return a list of module names.
+        '''
+        name = _normalize(alias)
+        if self._config is None:
+            self._config = self._read_config()
+        (aliases, commands) = self._config
+
+        lookups = (
+            lambda: [m for (pattern, m) in aliases if fnmatch.fnmatchcase(name, pattern)],
+            # module names do not contain ':'
+            lambda: [] if ':' in name else self._search('dep', name, exact=True),
+            lambda: self._search('symbols', name) if name.startswith('symbol:') else [],
+            lambda: [name] if name in commands else [],
+            lambda: self._search('alias', name),
+            lambda: self._search('builtin', name, exact=True),
+            lambda: self._search('builtin.alias', name),
+        )
+        for lookup in lookups:
+            modules = lookup()
+            if modules:
+                return modules
+        return []
+
+    def module_available(self, module):
+        '''Check whether a module (or alias) is available, like "modinfo module".
+
+        This is the case if it resolves to a module which is in modules.dep or
+        built into the kernel.
+        '''
+        for m in self.lookup(module):
+            m = _normalize(m)
+            if self._search('dep', m, exact=True) or self._search('builtin', m, exact=True):
+                return True
+        return False
+
+
+def modules_dir():
+    '''Return the module tree of the running kernel, or $UBUNTU_DRIVERS_MODULES_DIR.'''
+
+    return (os.environ.get('UBUNTU_DRIVERS_MODULES_DIR') or
+            os.path.join('/lib/modules', os.uname().release))
+
+
+def get_module_index():
+    '''Get the ModuleIndex for modules_dir().
+
+    This is kept for subsequent calls, so that every index only gets loaded
+    once per run.
+
+    Return None if the module tree does not have a modules.dep index.
+    '''
+    directory = modules_dir()
+    if get_module_index.current is None or get_module_index.current.directory != directory:
+        if get_module_index.current is not None:
+            get_module_index.current.close()
+        get_module_index.current = ModuleIndex(directory)
+    if not get_module_index.current.available():
+        return None
+    return get_module_index.current
+
+
+get_module_index.current = None
+
+
+def module_available(module):
+    '''Check whether a kernel module (or alias) is available.
+
+    Return None if this cannot be determined, as there is no module index.
+    '''
+    index = get_module_index()
+    if index is None:
+        return None
+    return index.module_available(module)
+
+
+def resolve_alias(alias):
+    '''Get the modules which handle an alias, like "modprobe --resolve-alias".
+
+    Return None if this cannot be determined, as there is no module index.
+    '''
+    index = get_module_index()
+    if index is None:
+        return None
+    return index.lookup(alias)
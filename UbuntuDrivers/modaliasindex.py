@@ -0,0 +1,191 @@
+'''Persistent modalias → package index.'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import json
+import logging
+
+import apt_pkg
+
+from UbuntuDrivers.packagelists import packages_files
+
+
+# Packages fields which are kept in the segments
+_SEGMENT_FIELDS = ('Package', 'Version', 'Architecture', 'Modaliases', 'Depends')
+
+# bump this when the layout of the index or the segments changes
+MODALIAS_INDEX_FORMAT = 1
+
+
+def index_path():
+    return os.path.join(os.environ.get('UBUNTU_DRIVERS_CACHE_DIR', '/var/lib/ubuntu-drivers-common'),
+                        'modalias-index.json')
+
+
+def _file_state(path):
+    try:
+        st = os.stat(path)
+    except OSError:
+        return [path, None, None]
+    return [path, st.st_mtime_ns, st.st_size]
+
+
+def apt_state_key(lists_dir, status_file, *tags):
+    '''Get the key for the current apt state.
+
+    This consists of MODALIAS_INDEX_FORMAT, the given tags (other values which
+    the index depends on, such as the architecture), and the path, mtime and size of the Packages
+    lists in lists_dir, the binary package cache, the dpkg status_file and the
+    apt preferences, which together determine the candidate versions of all
+    packages.
+    '''
+    files = packages_files(lists_dir) + [apt_pkg.config.find_file('Dir::Cache::pkgcache'),
+                                         status_file,
+                                         apt_pkg.config.find_file('Dir::Etc::preferences'),
+                                         apt_pkg.config.find_dir('Dir::Etc::preferencesparts')]
+    return [MODALIAS_INDEX_FORMAT] + list(tags) + [_file_state(f) for f in files]
+
+
+def load(key):
+    '''Load the modalias index if it is still valid for key.
+
+    The key is the first line of the index file; the rest of it is only read
+    and parsed if the key matches.
+
+    Return (modalias_map, video_abi_compat) with a map bus → modalias →
+    [package, ...] and a map package → bool, or None if there is no valid
+    index.
+    '''
+    path = index_path()
+    try:
+        with open(path, encoding='UTF-8') as f:
+            if json.loads(f.readline()) != key:
+                return None
+            modalias_map = json.loads(f.readline())
+            video_abi_compat = json.loads(f.readline())
+    except (IOError, OSError, ValueError):
+        return None
+    logging.debug('modalias index: using %s', path)
+    return (modalias_map, video_abi_compat)
+
+
+def save(key, modalias_map, video_abi_compat):
+    '''Save modalias_map (bus → modalias → packages) as index for key.
+
+    video_abi_compat maps the name of every driver package to whether it is
+    compatible with the current X.org video ABI, so that this does not need to
+    be checked again while the index is valid.
+    '''
+    path = index_path()
+    try:
+        with open(path + '.new', 'w') as f:
+            json.dump(key, f)
+            f.write('\n')
+            json.dump(dict((bus, dict((alias, sorted(pkgs)) for alias, pkgs in aliases.items()))
+                           for bus, aliases in modalias_map.items()), f)
+            f.write('\n')
+            json.dump(video_abi_compat, f, sort_keys=True)
+            f.write('\n')
+        os.rename(path + '.new', path)
+    except (IOError, OSError) as e:
+        logging.debug('modalias index: Cannot write %s: %s', path, e)
+
+
+def segments_dir():
+    return os.path.join(os.environ.get('UBUNTU_DRIVERS_CACHE_DIR', '/var/lib/ubuntu-drivers-common'),
+                        'modalias-segments')
+
+
+def _read_segment(path, installed_only=False):
+    '''Parse the stanzas with a Modaliases header from a Packages or dpkg status file.
+
+    Return a map package name → [record, ...] with the _SEGMENT_FIELDS of each
+    stanza.
+    '''
+    packages = {}
+    try:
+        tagfile = apt_pkg.TagFile(path)
+    except (IOError, SystemError) as e:
+        logging.debug('modalias index: Cannot read %s: %s', path, e)
+        return packages
+    with tagfile:
+        for section in tagfile:
+            if 'Modaliases' not in section:
+                continue
+            if installed_only and not section.get('Status', '').endswith(' installed'):
+                continue
+            try:
+                record = dict((f, section[f]) for f in _SEGMENT_FIELDS if f in section)
+            except UnicodeDecodeError:
+                logging.debug('modalias index: %s has an invalid stanza for %s', path, section.get('Package'))
+                continue
+            packages.setdefault(record['Package'], []).append(record)
+    return packages
+
+
+def update_segments(lists_dir, status_file):
+    '''Update the index segments for the Packages lists and the dpkg status.
+
+    The index keeps one segment with the driver package stanzas for each
+    Packages list (and one for the dpkg status) in
+    /var/lib/ubuntu-drivers-common/modalias-segments/ (or
+    $UBUNTU_DRIVERS_CACHE_DIR). Only the segments of files which changed since
+    they were written get parsed again; segments of lists which went away are
+    removed.
+
+    Return a map package name → [record, ...] of all segments, or None if
+    there are no Packages lists.
+    '''
+    lists = packages_files(lists_dir)
+    if not lists:
+        return None
+
+    directory = segments_dir()
+    try:
+        os.makedirs(directory, exist_ok=True)
+    except OSError as e:
+        logging.debug('modalias index: Cannot create %s: %s', directory, e)
+
+    result = {}
+    names = set()
+    for path in lists + [status_file]:
+        name = os.path.basename(path) + '.json'
+        names.add(name)
+        segment_path = os.path.join(directory, name)
+        state = _file_state(path)
+        try:
+            with open(segment_path) as f:
+                segment = json.load(f)
+            if segment['format'] != MODALIAS_INDEX_FORMAT or segment['state'] != state:
+                segment = None
+        except (IOError, ValueError, KeyError, TypeError):
+            segment = None
+
+        if segment is None:
+            logging.debug('modalias index: updating segment for %s', path)
+            segment = {'format': MODALIAS_INDEX_FORMAT, 'state': state,
+                       'packages': _read_segment(path, path == status_file)}
+            try:
+                with open(segment_path + '.new', 'w') as f:
+                    json.dump(segment, f)
+                os.rename(segment_path + '.new', segment_path)
+            except (IOError, OSError) as e:
+                logging.debug('modalias index: Cannot write %s: %s', segment_path, e)
+
+        for pkg, records in segment['packages'].items():
+            result.setdefault(pkg, []).extend(records)
+
+    try:
+        for name in os.listdir(directory):
+            if name not in names:
+                os.unlink(os.path.join(directory, name))
+    except OSError:
+        pass
+
+    return result
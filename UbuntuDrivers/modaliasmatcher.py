@@ -0,0 +1,486 @@
+'''Fast matching of modaliases against driver package modalias patterns.'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import array
+import collections
+import fnmatch
+import itertools
+import operator
+import re
+import weakref
+
+
+def _literal_prefix(pattern):
+    '''Return the part of a glob pattern before the first wildcard.'''
+
+    for i, c in enumerate(pattern):
+        if c in '*?[':
+            return pattern[:i]
+    return pattern
+
+
+def _bucket_add(buckets, key, i):
+    '''Add pattern number i to the bucket for key.
+
+    Most buckets only have one pattern, so these are stored as plain integers,
+    and only turned into an array when a second one gets added.
+    '''
+    bucket = buckets.get(key)
+    if bucket is None:
+        buckets[key] = i
+    elif isinstance(bucket, int):
+        buckets[key] = array.array('I', (bucket, i))
+    else:
+        bucket.append(i)
+
+
+def _bucket(buckets, key):
+    '''Return the pattern numbers in the bucket for key.'''
+
+    bucket = buckets.get(key, ())
+    if isinstance(bucket, int):
+        return (bucket,)
+    return bucket
+
+
+class _Index(object):
+    '''Base class for the modalias pattern indexes of one bus.
+
+    The indexes only store the numbers of the patterns in the _CompactBus they
+    are built from. The patterns are only compiled into regular expressions
+    when they are checked for the first time.
+    '''
+
+    def __init__(self, aliases):
+        self._aliases = aliases
+        self._regexes = {}
+
+    def _match_patterns(self, patterns, modalias, result):
+        '''Add the package IDs of the given patterns which match modalias to result.'''
+
+        for i in patterns:
+            regex = self._regexes.get(i)
+            if regex is None:
+                regex = self._regexes[i] = re.compile(fnmatch.translate(self._aliases.pattern(i))).match
+            if regex(modalias):
+                result.update(self._aliases.package_ids(i))
+
+
+class _PrefixIndex(_Index):
+    '''Glob patterns, indexed by their literal prefix.
+
+    A modalias can only match patterns whose literal prefix is a prefix of the
+    modalias, so a lookup only checks the patterns in the buckets for the
+    prefixes of the modalias, instead of every pattern.
+    '''
+
+    def __init__(self, aliases):
+        _Index.__init__(self, aliases)
+        self._buckets = {}
+        self._lengths = []
+
+    def add(self, i, pattern):
+        '''Add pattern number i.'''
+
+        prefix = _literal_prefix(pattern)
+        if prefix not in self._buckets and len(prefix) not in self._lengths:
+            self._lengths.append(len(prefix))
+            self._lengths.sort()
+        _bucket_add(self._buckets, prefix, i)
+
+    def match(self, modalias, result):
+        '''Add the package IDs of all patterns matching modalias to result.'''
+
+        for length in self._lengths:
+            if length > len(modalias):
+                break
+            self._match_patterns(_bucket(self._buckets, modalias[:length]), modalias, result)
+
+
+# PCI modaliases are "pci:v<vendor>d<device>sv<subvendor>sd<subdevice>bc<class>sc<subclass>i<interface>"
+_pci_modalias_re = re.compile('^pci:v([0-9a-f]{8})d([0-9a-f]{8})sv([0-9a-f]{8})sd([0-9a-f]{8})'
+                              'bc([0-9a-f]{2})sc([0-9a-f]{2})i([0-9a-f]{2})$')
+# the same with every field being either literal or '*'
+_pci_pattern_re = re.compile(r'^pci:v([0-9a-f]{8}|\*)d([0-9a-f]{8}|\*)sv([0-9a-f]{8}|\*)sd([0-9a-f]{8}|\*)'
+                             r'bc([0-9a-f]{2}|\*)sc([0-9a-f]{2}|\*)i([0-9a-f]{2}|\*)$')
+
+
+def _id_key(ids, bits):
+    '''Combine hex IDs of the given width into one integer dictionary key.
+
+    None (for a '*' field) gets the value 1 << bits, which no ID can have.
+    '''
+    key = 0
+    for i in ids:
+        key = key << (bits + 1) | (1 << bits if i is None else int(i, 16))
+    return key
+
+
+class _PciIndex(_Index):
+    '''PCI modalias patterns, indexed by vendor and device ID.
+
+    Almost all PCI patterns consist of fields which are either literal or '*'.
+    These are stored under their vendor and device ID (None for '*'), so that a
+    lookup is a dictionary hit and a few comparisons of the remaining fields.
+    The separators of the fields cannot occur in the hex IDs, so this gives the
+    same result as the glob match. Other patterns fall back to glob matching,
+    and so do modaliases which are not well-formed.
+    '''
+
+    def __init__(self, aliases):
+        _Index.__init__(self, aliases)
+        self._ids = {}
+        self._globs = _PrefixIndex(aliases)
+
+    def add(self, i, pattern):
+        '''Add pattern number i.'''
+
+        m = _pci_pattern_re.match(pattern)
+        if not m:
+            self._globs.add(i, pattern)
+            return
+        _bucket_add(self._ids, _id_key([f != '*' and f or None for f in m.group(1, 2)], 32), i)
+
+    def match(self, modalias, result):
+        '''Add the package IDs of all patterns matching modalias to result.'''
+
+        m = _pci_modalias_re.match(modalias)
+        if not m:
+            for key in self._ids:
+                self._match_patterns(_bucket(self._ids, key), modalias, result)
+            self._globs.match(modalias, result)
+            return
+
+        fields = m.groups()[2:]
+        for vendor in (m.group(1), None):
+            for device in (m.group(2), None):
+                for i in _bucket(self._ids, _id_key((vendor, device), 32)):
+                    record = _pci_pattern_re.match(self._aliases.pattern(i)).groups()[2:]
+                    for (field, value) in zip(record, fields):
+                        if field != '*' and field != value:
+                            break
+                    else:
+                        result.update(self._aliases.package_ids(i))
+        self._globs.match(modalias, result)
+
+
+# USB modaliases start with "usb:v<vendor>p<product>"
+_usb_id_re = re.compile('^usb:v([0-9a-f]{4})p(?:([0-9a-f]{4}))?')
+
+
+class _UsbIndex(_Index):
+    '''USB modalias patterns, indexed by vendor and product ID.
+
+    Patterns whose literal prefix contains the vendor ID (and usually the
+    product ID) are stored under these, so that a lookup only has to check the
+    patterns for the device's own IDs. All others fall back to glob matching.
+    '''
+
+    def __init__(self, aliases):
+        _Index.__init__(self, aliases)
+        self._ids = {}
+        self._globs = _PrefixIndex(aliases)
+
+    def add(self, i, pattern):
+        '''Add pattern number i.'''
+
+        m = _usb_id_re.match(_literal_prefix(pattern))
+        if not m:
+            self._globs.add(i, pattern)
+            return
+        _bucket_add(self._ids, _id_key(m.groups(), 16), i)
+
+    def match(self, modalias, result):
+        '''Add the package IDs of all patterns matching modalias to result.'''
+
+        m = _usb_id_re.match(modalias)
+        if m:
+            for key in (m.groups(), (m.group(1), None)):
+                self._match_patterns(_bucket(self._ids, _id_key(key, 16)), modalias, result)
+        self._globs.match(modalias, result)
+
+
+# a literal product name field "pn<name>:" in a DMI pattern
+_dmi_pattern_pn_re = re.compile(r'pn([^:*?]+):')
+
+
+class _DmiIndex(_Index):
+    '''DMI modalias patterns, indexed by product name.
+
+    OEM packages use long globs like "dmi:*:pn<name>:*". A modalias can only
+    match such a pattern if it contains the literal "pn<name>:" as well, so
+    patterns are stored under their product name, and a lookup only checks the
+    patterns for the "pn...:" tokens which appear in the modalias. Patterns
+    without a literal product name fall back to glob matching.
+    '''
+
+    def __init__(self, aliases):
+        _Index.__init__(self, aliases)
+        self._names = {}
+        self._globs = _PrefixIndex(aliases)
+
+    def add(self, i, pattern):
+        '''Add pattern number i.'''
+
+        m = '[' not in pattern and _dmi_pattern_pn_re.search(pattern)
+        if not m:
+            self._globs.add(i, pattern)
+            return
+        _bucket_add(self._names, m.group(1), i)
+
+    def match(self, modalias, result):
+        '''Add the package IDs of all patterns matching modalias to result.'''
+
+        names = set()
+        start = modalias.find('pn')
+        while start >= 0:
+            end = modalias.find(':', start + 2)
+            if end < 0:
+                break
+            names.add(modalias[start + 2:end])
+            start = modalias.find('pn', start + 1)
+
+        for name in names:
+            self._match_patterns(_bucket(self._names, name), modalias, result)
+        self._globs.match(modalias, result)
+
+
+class _CompactBus(object):
+    '''The modalias patterns of one bus and their packages, in arrays.
+
+    The sorted patterns are concatenated into one string with an array of
+    offsets, and the package IDs of all patterns are stored in one array with
+    another array of offsets into it. With lower, the patterns are stored in
+    lower case, and the packages of patterns which only differ in case are
+    merged.
+    '''
+
+    def __init__(self, aliases, names, ids, typecode, lower=False):
+        patterns = sorted(((lower and pattern.lower() or pattern, pkgs) for (pattern, pkgs) in aliases.items()),
+                          key=operator.itemgetter(0))
+        self._names = names
+        self._offsets = array.array('I', [0])
+        self._package_ids = array.array(typecode)
+        self._package_offsets = array.array('I', [0])
+        blob = []
+        for pattern, group in itertools.groupby(patterns, operator.itemgetter(0)):
+            blob.append(pattern)
+            self._offsets.append(self._offsets[-1] + len(pattern))
+            self._package_ids.extend(sorted(set(ids[p] for (_, pkgs) in group for p in pkgs)))
+            self._package_offsets.append(len(self._package_ids))
+        self._blob = ''.join(blob)
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def pattern(self, i):
+        '''Return the i-th pattern.'''
+
+        return self._blob[self._offsets[i]:self._offsets[i + 1]]
+
+    def package_ids(self, i):
+        '''Return the array of package IDs of the i-th pattern.'''
+
+        return self._package_ids[self._package_offsets[i]:self._package_offsets[i + 1]]
+
+    def __iter__(self):
+        return (self.pattern(i) for i in range(len(self)))
+
+    def __getitem__(self, pattern):
+        lo = 0
+        hi = len(self)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.pattern(mid) < pattern:
+                lo = mid + 1
+            else:
+                hi = mid
+        if lo == len(self) or self.pattern(lo) != pattern:
+            raise KeyError(pattern)
+        return tuple(self._names[i] for i in self.package_ids(lo))
+
+    def __contains__(self, pattern):
+        try:
+            self[pattern]
+            return True
+        except KeyError:
+            return False
+
+    def items(self):
+        for i in range(len(self)):
+            yield (self.pattern(i), tuple(self._names[j] for j in self.package_ids(i)))
+
+
+class CompactModaliasMap(object):
+    '''Compact form of a bus → modalias pattern → packages map.
+
+    Package names are interned into integer IDs (indexes into names), and
+    every bus keeps its patterns and their package IDs in sorted arrays, so
+    that the map needs only a fraction of the memory of the nested dictionaries
+    and sets. It can be used like the dictionary it was built from.
+
+    With lower, all patterns are converted to lower case, as needed by
+    ModaliasMatcher.
+    '''
+
+    def __init__(self, modalias_map, lower=False):
+        self.lower = lower
+        self.names = sorted(set(p for (_, aliases) in modalias_map.items()
+                                for (_, pkgs) in aliases.items() for p in pkgs))
+        ids = dict((name, i) for i, name in enumerate(self.names))
+        typecode = len(self.names) <= 0xFFFF and 'H' or 'I'
+        self._buses = {}
+        for bus, aliases in modalias_map.items():
+            self._buses[bus] = _CompactBus(aliases, self.names, ids, typecode, lower)
+
+    def __getitem__(self, bus):
+        return self._buses[bus]
+
+    def __contains__(self, bus):
+        return bus in self._buses
+
+    def __iter__(self):
+        return iter(self._buses)
+
+    def __len__(self):
+        return len(self._buses)
+
+    def get(self, bus, default=None):
+        return self._buses.get(bus, default)
+
+    def keys(self):
+        return self._buses.keys()
+
+    def items(self):
+        return self._buses.items()
+
+
+# bus → index class for buses with a structured modalias format
+_bus_indexes = {'pci': _PciIndex, 'usb': _UsbIndex, 'dmi': _DmiIndex}
+
+
+class ModaliasMatcher(object):
+    '''Matcher for a bus → modalias pattern → packages map.
+
+    This is built once from the result of _apt_cache_modalias_map() (or a
+    CompactModaliasMap of it) and then finds the packages for a modalias
+    without trying every pattern of its bus. Matching is case insensitive, like
+    fnmatch.fnmatch() on the lower case modalias and pattern, and gives exactly
+    the same results.
+
+    The patterns and their packages are only kept once, in a lower case
+    CompactModaliasMap; the indexes refer to the patterns by their number.
+    '''
+
+    def __init__(self, modalias_map):
+        if not isinstance(modalias_map, CompactModaliasMap) or not modalias_map.lower:
+            modalias_map = CompactModaliasMap(modalias_map, lower=True)
+        self._map = modalias_map
+        self._buses = {}
+        for bus, aliases in modalias_map.items():
+            index = _bus_indexes.get(bus, _PrefixIndex)(aliases)
+            for i in range(len(aliases)):
+                index.add(i, aliases.pattern(i))
+            self._buses[bus] = index
+
+    def match(self, modalias):
+        '''Return the set of package names which apply to modalias.'''
+
+        result = set()
+        index = self._buses.get(modalias.split(':', 1)[0])
+        if index is not None:
+            index.match(modalias.lower(), result)
+        return set(self._map.names[i] for i in result)
+
+
+class ModaliasMatcherCache(object):
+    '''Bounded cache of ModaliasMatcher objects for apt.Cache objects.
+
+    Entries only hold a weak reference to their apt.Cache, and are dropped as
+    soon as it is garbage collected or reopened (e. g. after an update). At
+    most maxsize entries are kept; the least recently used one is evicted
+    when a new one is added.
+
+    build is called with an apt.Cache object to create its matcher.
+    '''
+
+    def __init__(self, build, maxsize=4):
+        self.build = build
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._connected = weakref.WeakSet()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, apt_cache):
+        '''Return the ModaliasMatcher for apt_cache, building it if necessary.'''
+
+        key = id(apt_cache)
+        try:
+            ref, matcher = self._entries[key]
+        except KeyError:
+            pass
+        else:
+            if ref() is apt_cache:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return matcher
+            # stale entry of a collected object whose id got reused
+            del self._entries[key]
+
+        self.misses += 1
+        matcher = self.build(apt_cache)
+        self._add(apt_cache, matcher)
+        return matcher
+
+    def peek(self, apt_cache):
+        '''Return the ModaliasMatcher for apt_cache if it was built already, otherwise None.'''
+
+        entry = self._entries.get(id(apt_cache))
+        if entry is not None and entry[0]() is apt_cache:
+            return entry[1]
+        return None
+
+    def _add(self, apt_cache, matcher):
+        key = id(apt_cache)
+
+        def drop(ref, key=key):
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] is ref:
+                del self._entries[key]
+
+        self._entries[key] = (weakref.ref(apt_cache, drop), matcher)
+        if apt_cache not in self._connected:
+            # reopening the cache (e. g. after an update) changes its packages
+            cache_ref = weakref.ref(apt_cache)
+            apt_cache.connect('cache_post_open', lambda: self.invalidate(cache_ref()))
+            self._connected.add(apt_cache)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, apt_cache=None):
+        '''Drop the matcher for apt_cache, or all matchers if not given.'''
+
+        if apt_cache is None:
+            self._entries.clear()
+            return
+        entry = self._entries.get(id(apt_cache))
+        if entry is not None and entry[0]() is apt_cache:
+            del self._entries[id(apt_cache)]
+
+    def stats(self):
+        '''Return a dictionary with the size and hit statistics of the cache.'''
+
+        return {'size': len(self._entries), 'maxsize': self.maxsize, 'hits': self.hits,
+                'misses': self.misses, 'evictions': self.evictions}
+
+    def __len__(self):
+        return len(self._entries)
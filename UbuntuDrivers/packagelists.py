@@ -0,0 +1,276 @@
+'''Driver package information from apt Packages lists, without apt.Cache.'''
+
+# (C) 2020 Canonical Ltd.
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 2 of the License, or
+# (at your option) any later version.
+
+import os
+import re
+import logging
+
+import apt_pkg
+
+# names of packages which are kept even if they have no Modaliases or Support
+# header: the kernel images and headers for kernel detection, the kernel module
+# packages for get_linux_modules_metapackage() and the X.org server for the
+# video ABI check; see also _is_kernel_metapackage()
+KEEP_PREFIXES = ('nvidia-', 'linux-image-', 'linux-headers-', 'linux-modules-nvidia-')
+KEEP_NAMES = ('xserver-xorg-core',)
+
+_packages_file_re = re.compile(r'_Packages(\.(gz|bz2|xz|lz4|zst))?$')
+
+
+def _is_kernel_metapackage(section):
+    '''Check whether a stanza is a kernel metapackage like linux-generic.
+
+    KernelDetection.get_linux_metapackage() looks for these among the reverse
+    dependencies of the linux-image-* metapackage.
+    '''
+    name = section['Package']
+    if not name.startswith('linux-') or name.startswith('linux-modules-'):
+        return False
+    return 'linux-image-' in (section.get('Depends') or '')
+
+
+def _keep(section):
+    return ('Modaliases' in section or 'Support' in section or
+            section['Package'].startswith(KEEP_PREFIXES) or
+            section['Package'] in KEEP_NAMES or
+            _is_kernel_metapackage(section))
+
+
+def _section_dict(section, path):
+    '''Copy a TagSection into a dictionary.
+
+    Fields which are not valid UTF-8 are skipped.
+    '''
+    record = {}
+    for k in section.keys():
+        try:
+            record[k] = section[k]
+        except UnicodeDecodeError:
+            logging.debug('%s: package %s has invalid %s header', path, section.get('Package'), k)
+    return record
+
+
+def packages_files(lists_dir):
+    '''Return the paths of the Packages lists in an apt lists directory.'''
+
+    try:
+        names = os.listdir(lists_dir)
+    except OSError:
+        return []
+    return sorted(os.path.join(lists_dir, n) for n in names if _packages_file_re.search(n))
+
+
+def _release_origin(path):
+    '''Get the Origin of a Release or InRelease file.'''
+
+    try:
+        with open(path, encoding='UTF-8', errors='replace') as f:
+            for line in f:
+                if line.startswith('Origin:'):
+                    return line.split(':', 1)[1].strip()
+                if line.startswith(('MD5Sum:', 'SHA1:', 'SHA256:', 'SHA512:')):
+                    break
+    except IOError:
+        pass
+    return ''
+
+
+class Origin(object):
+    '''Origin of a package version, as far as it is known from the lists.'''
+
+    def __init__(self, origin, component):
+        self.origin = origin
+        self.component = component
+
+    def __repr__(self):
+        return '<Origin origin:%s component:%s>' % (self.origin, self.component)
+
+
+class BaseDependency(object):
+    def __init__(self, name, relation, version, rawtype):
+        self.name = name
+        self.relation = relation
+        self.version = version
+        self.rawtype = rawtype
+
+
+class Version(object):
+    '''A package version from a Packages list or the dpkg status.
+
+    This provides the attributes of apt.Version which ubuntu-drivers uses.
+    '''
+
+    def __init__(self, package, record, origins):
+        self.package = package
+        self.record = record
+        self.origins = origins
+        self.version = record.get('Version', '')
+        self.architecture = record.get('Architecture', '')
+
+    @property
+    def provides(self):
+        try:
+            return [p[0][0] for p in apt_pkg.parse_depends(self.record['Provides'])]
+        except (KeyError, ValueError):
+            return []
+
+    def get_dependencies(self, *types):
+        result = []
+        for t in types:
+            try:
+                ordeps = apt_pkg.parse_depends(self.record[t])
+            except (KeyError, ValueError):
+                continue
+            for ordep in ordeps:
+                result.append([BaseDependency(name, relation, version, t)
+                               for (name, version, relation) in ordep])
+        return result
+
+    @property
+    def dependencies(self):
+        return self.get_dependencies('PreDepends', 'Depends')
+
+    def __repr__(self):
+        return '<Version: package:%r version:%r>' % (self.package.name, self.version)
+
+
+class Package(object):
+    '''A package with its candidate and installed versions.
+
+    This provides the attributes of apt.Package which ubuntu-drivers uses.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.shortname = name.split(':', 1)[0]
+        self.candidate = None
+        self.installed = None
+        self.marked_install = False
+
+    @property
+    def is_installed(self):
+        return self.installed is not None
+
+    def _add_version(self, version):
+        if (self.candidate is None or
+                apt_pkg.version_compare(version.version, self.candidate.version) > 0):
+            self.candidate = version
+
+    def __repr__(self):
+        return '<Package: name:%r>' % self.name
+
+
+class PackageLists(object):
+    '''Driver packages from the apt Packages lists, as an apt.Cache substitute.
+
+    This streams the *_Packages files from the apt lists directory with
+    apt_pkg.TagFile and only keeps the packages which are relevant for driver
+    detection: the ones with a Modaliases or Support header, and nvidia and
+    linux kernel packages (see KEEP_PREFIXES and KEEP_NAMES). So it needs much
+    less memory and time than apt.Cache(), and can be passed to the functions
+    in UbuntuDrivers.detect instead of it for querying drivers.
+
+    The candidate of a package is the highest available version for the native
+    architecture; apt pinning is not taken into account. The installed
+    versions come from the dpkg status file.
+    '''
+
+    def __init__(self, lists_dir=None, status_file=None, architecture=None):
+        self.lists_dir = lists_dir or apt_pkg.config.find_dir('Dir::State::Lists')
+        self.status_file = status_file or apt_pkg.config.find_file('Dir::State::status')
+        self.architecture = architecture or apt_pkg.get_architectures()[0]
+        self._packages = {}
+        self._callbacks = {}
+
+        for path in self.packages_files():
+            self._read_packages_file(path)
+        self._read_status()
+
+    def packages_files(self):
+        '''Return the paths of the Packages lists.'''
+
+        return packages_files(self.lists_dir)
+
+    def _origin(self, path):
+        '''Determine the Origin of a Packages list from its Release file.'''
+
+        prefix = _packages_file_re.sub('', path)
+        # strip the "_<component>_binary-<arch>" part to get the dists dir
+        dists = prefix.rsplit('_binary-', 1)[0]
+        while True:
+            for release in ('_InRelease', '_Release'):
+                if os.path.exists(dists + release):
+                    component = prefix[len(dists) + 1:].rsplit('_binary-', 1)[0].replace('_', '/')
+                    return Origin(_release_origin(dists + release), component)
+            if '_' not in os.path.basename(dists):
+                return Origin('', '')
+            dists = dists.rsplit('_', 1)[0]
+
+    def _get_package(self, name):
+        try:
+            return self._packages[name]
+        except KeyError:
+            pkg = self._packages[name] = Package(name)
+            return pkg
+
+    def _read_packages_file(self, path):
+        origins = [self._origin(path)]
+        logging.debug('PackageLists: reading %s', path)
+        try:
+            tagfile = apt_pkg.TagFile(path)
+        except (IOError, SystemError) as e:
+            logging.warning('Cannot read %s: %s', path, e)
+            return
+        with tagfile:
+            for section in tagfile:
+                if (section.get('Architecture') not in ('all', self.architecture) or
+                        not _keep(section)):
+                    continue
+                pkg = self._get_package(section['Package'])
+                pkg._add_version(Version(pkg, _section_dict(section, path), origins))
+
+    def _read_status(self):
+        try:
+            tagfile = apt_pkg.TagFile(self.status_file)
+        except (IOError, SystemError) as e:
+            logging.debug('Cannot read %s: %s', self.status_file, e)
+            return
+        with tagfile:
+            for section in tagfile:
+                if (not section.get('Status', '').endswith(' installed') or
+                        section.get('Architecture') not in ('all', self.architecture) or
+                        not _keep(section)):
+                    continue
+                pkg = self._get_package(section['Package'])
+                record = _section_dict(section, self.status_file)
+                if pkg.candidate is not None and pkg.candidate.version == record.get('Version'):
+                    pkg.installed = pkg.candidate
+                else:
+                    pkg.installed = Version(pkg, record, [])
+                    pkg._add_version(pkg.installed)
+
+    def connect(self, name, callback):
+        '''Connect to a signal; package lists never get reopened.'''
+
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def __getitem__(self, name):
+        return self._packages[name]
+
+    def __contains__(self, name):
+        return name in self._packages
+
+    def __iter__(self):
+        return iter(self._packages.values())
+
+    def __len__(self):
+        return len(self._packages)
+
+    def keys(self):
+        return list(self._packages)
@@ -34,6 +34,7 @@ setup(
                 ("/usr/share/ubuntu-drivers-common/detect", glob.glob("detect-plugins/*")),
                 ("/usr/share/doc/ubuntu-drivers-common", ['README']),
                 ("/usr/lib/nvidia/", glob.glob("nvidia-installer-hooks/*")),
+                ("/etc/apt/apt.conf.d/", glob.glob("apt-hooks/*")),
                 ("/usr/lib/ubiquity/target-config", glob.glob("ubiquity/target-config/*")),
                ] + extra_data,
     scripts=["nvidia-detector", "quirks-handler", "ubuntu-drivers"],
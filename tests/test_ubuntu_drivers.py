@@ -9,6 +9,9 @@
 # (at your option) any later version.
 
 import os
+import json
+import fnmatch
+import gc
 import unittest
 import subprocess
 import resource
@@ -16,14 +19,21 @@ import sys
 import tempfile
 import shutil
 import logging
+import tracemalloc
 
 # from gi.repository import GLib
 from gi.repository import UMockdev
 import apt
 import aptdaemon.test
 
+import UbuntuDrivers.aptscan
 import UbuntuDrivers.detect
+import UbuntuDrivers.hwdb
 import UbuntuDrivers.kerneldetection
+import UbuntuDrivers.kmodindex
+import UbuntuDrivers.modaliasindex
+import UbuntuDrivers.modaliasmatcher
+import UbuntuDrivers.packagelists
 
 import testarchive
 
@@ -111,6 +121,57 @@ def gen_fakearchive():
     return a
 
 
+class FakeCache(object):
+    '''Minimal stand-in for an apt.Cache with packagelists.Package objects.
+
+    It can also hold the packages of a real apt.Cache, to test the code paths
+    for caches without apt_pkg objects. Signal callbacks are recorded by name,
+    and can be called with emit().
+    '''
+
+    def __init__(self, packages=()):
+        self.packages = dict((pkg.name, pkg) for pkg in packages)
+        self.callbacks = {}
+
+    def connect(self, name, callback):
+        self.callbacks.setdefault(name, []).append(callback)
+
+    def emit(self, name):
+        for callback in self.callbacks.get(name, []):
+            callback()
+
+    def keys(self):
+        return self.packages.keys()
+
+    def __getitem__(self, name):
+        return self.packages[name]
+
+    def __contains__(self, name):
+        return name in self.packages
+
+    def __iter__(self):
+        return iter(self.packages.values())
+
+    def package(self, name, depends=None, installed=False, record=None, origins=()):
+        '''Add a package with a candidate for the system architecture and return it.
+
+        record has additional fields of the candidate. installed is True to
+        install the candidate, or the Depends of a different installed version.
+        '''
+        pl = UbuntuDrivers.packagelists
+        pkg = self.packages[name] = pl.Package(name)
+        fields = {'Package': name, 'Architecture': UbuntuDrivers.detect.system_architecture, 'Version': '1'}
+        if depends:
+            fields['Depends'] = depends
+        fields.update(record or {})
+        pkg.candidate = pl.Version(pkg, fields, list(origins))
+        if installed is True:
+            pkg.installed = pkg.candidate
+        elif installed:
+            pkg.installed = pl.Version(pkg, dict(fields, Depends=installed), list(origins))
+        return pkg
+
+
 def get_deb_arch():
     proc = subprocess.Popen(['dpkg', '--print-architecture'], stdout=subprocess.PIPE,
                             universal_newlines=True)
@@ -135,12 +196,18 @@ class DetectTest(unittest.TestCase):
         os.environ['UBUNTU_DRIVERS_DETECT_DIR'] = self.plugin_dir
         os.environ['UBUNTU_DRIVERS_SYS_DIR'] = self.umockdev.get_sys_dir()
 
+        # do not use or clobber the system's modalias snapshot and index
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = self.cache_dir
+
     def tearDown(self):
         shutil.rmtree(self.plugin_dir)
+        shutil.rmtree(self.cache_dir)
+        del os.environ['UBUNTU_DRIVERS_CACHE_DIR']
 
         # most test cases switch the apt root, so the apt.Cache() cache becomes
         # unreliable; reset it
-        UbuntuDrivers.detect.packages_for_modalias.cache_maps = {}
+        UbuntuDrivers.detect.packages_for_modalias.cache_maps.invalidate()
 
     @unittest.skipUnless(os.path.isdir('/sys/devices'), 'no /sys dir on this system')
     def test_system_modaliases_system(self):
@@ -169,6 +236,109 @@ class DetectTest(unittest.TestCase):
             modalias_nv]))
         self.assertTrue(res['pci:vDEADBEEFd00'].endswith('/sys/devices/grey'))
 
+    def test_system_modaliases_buses(self):
+        '''system_modaliases() restricted to some buses'''
+
+        res = UbuntuDrivers.detect.system_modaliases(self.umockdev.get_sys_dir(), buses=['usb'])
+        self.assertEqual(set(res), set([
+            'usb:v9876dABCDsv01sd02bc00sc01i05',
+            'usb:v1234dABCDsv01sd02bc00sc01i05']))
+        self.assertTrue(res['usb:v9876dABCDsv01sd02bc00sc01i05'].endswith('/sys/devices/black'))
+
+    def test_system_modaliases_not_on_bus(self):
+        '''system_modaliases() finds devices which are not on a bus'''
+
+        sys_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, sys_dir)
+
+        def add_device(path, modalias, link=None):
+            os.makedirs(os.path.join(sys_dir, 'devices', path))
+            with open(os.path.join(sys_dir, 'devices', path, 'modalias'), 'w') as f:
+                f.write(modalias + '\n')
+            if link:
+                os.makedirs(os.path.join(sys_dir, os.path.dirname(link)), exist_ok=True)
+                os.symlink(os.path.relpath(os.path.join(sys_dir, 'devices', path),
+                                           os.path.join(sys_dir, os.path.dirname(link))),
+                           os.path.join(sys_dir, link))
+
+        add_device('pci0000:00/0000:00:02.0', 'pci:v00008086d00003E92sv00001028sd0000085Cbc03sc00i00',
+                   'bus/pci/devices/0000:00:02.0')
+        # the CPU node is on no bus or class
+        add_device('system/cpu', 'cpu:type:x86,ven0000fam0006mod009E:feature:,0000,0001')
+        add_device('virtual/input/input3', 'input:b0019v0000p0001e0000-e0,1,k74,ramlsfw',
+                   'class/input/input3')
+        add_device('virtual/dmi/id', 'dmi:bvnDell:pnXPS137390:', 'class/dmi/id')
+
+        res = UbuntuDrivers.detect.system_modaliases(sys_dir)
+        self.assertEqual(res['cpu:type:x86,ven0000fam0006mod009E:feature:,0000,0001'],
+                         os.path.join(sys_dir, 'devices/system/cpu'))
+        self.assertIn('input:b0019v0000p0001e0000-e0,1,k74,ramlsfw', res)
+        # same result as walking the whole device tree
+        self.assertEqual(res, dict(UbuntuDrivers.detect._iter_walk_modaliases(sys_dir)))
+
+        self.assertEqual(set(UbuntuDrivers.detect.system_modaliases(sys_dir, buses=['cpu', 'dmi'])),
+                         set(['cpu:type:x86,ven0000fam0006mod009E:feature:,0000,0001',
+                              'dmi:bvnDell:pnXPS137390:']))
+
+    def test_system_modaliases_snapshot(self):
+        '''system_modaliases() snapshot is reused until the next uevent'''
+
+        sys_dir = self.umockdev.get_sys_dir()
+        os.makedirs(os.path.join(sys_dir, 'kernel'), exist_ok=True)
+        seqnum = os.path.join(sys_dir, 'kernel', 'uevent_seqnum')
+        with open(seqnum, 'w') as f:
+            f.write('1\n')
+
+        res = UbuntuDrivers.detect.system_modaliases(sys_dir)
+        self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'modaliases.json')))
+
+        # without a new uevent the snapshot is used
+        self.umockdev.add_device('pci', 'hotplugged', None, ['modalias', 'pci:v0000CAFEd00'], [])
+        self.assertEqual(UbuntuDrivers.detect.system_modaliases(sys_dir), res)
+
+        # snapshots of another format are not used
+        snapshot_path = os.path.join(self.cache_dir, 'modaliases.json')
+        with open(snapshot_path) as f:
+            snapshot = json.load(f)
+        self.assertEqual(snapshot['key'][0], UbuntuDrivers.detect.MODALIAS_SNAPSHOT_FORMAT)
+        snapshot['key'][0] -= 1
+        with open(snapshot_path, 'w') as f:
+            json.dump(snapshot, f)
+        self.assertTrue('pci:v0000CAFEd00' in UbuntuDrivers.detect.system_modaliases(sys_dir))
+
+        with open(seqnum, 'w') as f:
+            f.write('2\n')
+        res = UbuntuDrivers.detect.system_modaliases(sys_dir)
+        self.assertTrue('pci:v0000CAFEd00' in res)
+
+    def test_system_modalias_devices(self):
+        '''system_modalias_devices() keeps devices with the same modalias'''
+
+        self.umockdev.add_device('pci', 'white2', None,
+                                 ['modalias', 'pci:v00001234d00sv00000001sd00bc00sc00i00'], [])
+        res = UbuntuDrivers.detect.system_modalias_devices(self.umockdev.get_sys_dir())
+        self.assertEqual(
+            sorted(os.path.basename(p) for p in res['pci:v00001234d00sv00000001sd00bc00sc00i00']),
+            ['white', 'white2'])
+        self.assertEqual(len(res['pci:vDEADBEEFd00']), 1)
+
+    def test_iter_system_modaliases(self):
+        '''iter_system_modaliases() for fake sysfs'''
+
+        self.umockdev.add_device('pci', 'white2', None,
+                                 ['modalias', 'pci:v00001234d00sv00000001sd00bc00sc00i00'], [])
+        res = list(UbuntuDrivers.detect.iter_system_modaliases(self.umockdev.get_sys_dir()))
+        self.assertEqual(len(res), 9)
+        self.assertEqual(set(res), set((alias, path) for (alias, paths) in
+                         UbuntuDrivers.detect.system_modalias_devices(self.umockdev.get_sys_dir()).items()
+                         for path in paths))
+
+        # can stop early
+        it = UbuntuDrivers.detect.iter_system_modaliases(self.umockdev.get_sys_dir())
+        alias, path = next(it)
+        self.assertTrue(':' in alias)
+        it.close()
+
     def test_system_driver_packages_performance(self):
         '''system_driver_packages() performance for a lot of modaliases'''
 
@@ -193,6 +363,165 @@ class DetectTest(unittest.TestCase):
 
         self.assertLess(sec, target)
 
+    def test_packages_for_modaliases_chroot(self):
+        '''packages_for_modaliases() for test package repository'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+            aliases = ['pci:v0000BEEFd00sv00000001sd00bc00sc00i00',
+                       'usb:v1234dABCDsv01sd02bc00sc01i05',
+                       'pci:v0000BEEFd00sv00000001sd00bc00sc00i00',
+                       'pci:v0000FFFFd00sv00000001sd00bc00sc00i00']
+            res = UbuntuDrivers.detect.packages_for_modaliases(cache, iter(aliases))
+            single = UbuntuDrivers.detect.packages_for_modalias(cache, aliases[0])
+
+            # results are produced while the modaliases are still coming in
+            produced = []
+
+            def gen():
+                for alias in aliases:
+                    produced.append(alias)
+                    yield alias
+
+            it = UbuntuDrivers.detect.iter_packages_for_modaliases(cache, gen())
+            first = next(it)
+            self.assertEqual(produced, aliases[:1])
+            self.assertEqual(first[0], aliases[0])
+            self.assertEqual([alias for (alias, pkgs) in it], [aliases[1], aliases[3]])
+        finally:
+            chroot.remove()
+
+        self.assertEqual(list(res), [aliases[0], aliases[1], aliases[3]])
+        self.assertEqual(set([p.name for p in res[aliases[0]]]),
+                         set(['vanilla', 'chocolate', 'stracciatella', 'neapolitan', 'tuttifrutti']))
+        self.assertEqual([p.name for p in res[aliases[1]]], ['tuttifrutti'])
+        self.assertEqual(res[aliases[3]], [])
+        # package objects are shared between modaliases
+        tf = [p for p in res[aliases[0]] if p.name == 'tuttifrutti'][0]
+        self.assertIs(tf, res[aliases[1]][0])
+        self.assertEqual(set([p.name for p in single]), set([p.name for p in res[aliases[0]]]))
+
+    def test_packages_for_modalias_index(self):
+        '''packages_for_modalias() with persistent modalias index'''
+
+        index = os.path.join(self.cache_dir, 'modalias-index.json')
+        alias = 'pci:v00001234d00sv00000001sd00bc00sc00i00'
+
+        def names():
+            UbuntuDrivers.detect.packages_for_modalias.cache_maps.invalidate()
+            return set([p.name for p in UbuntuDrivers.detect.packages_for_modalias(cache, alias)])
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+
+            self.assertEqual(names(), set(['vanilla']))
+            self.assertTrue(os.path.exists(index))
+
+            # the index is used as long as the apt state is unchanged
+            with open(index) as f:
+                key = f.readline()
+                modalias_map = json.loads(f.readline())
+                video_abi_compat = json.loads(f.readline())
+            self.assertEqual(video_abi_compat['vanilla'], True)
+            self.assertEqual(video_abi_compat['nvidia-old'], False)
+            modalias_map['pci']['pci:v00001234d*sv*sd*bc*sc*i*'].append('chocolate')
+            with open(index, 'w') as f:
+                f.write(key)
+                json.dump(modalias_map, f)
+                f.write('\n')
+                json.dump(video_abi_compat, f)
+            self.assertEqual(names(), set(['vanilla', 'chocolate']))
+
+            # changing the package lists invalidates it
+            lists = apt.apt_pkg.config.find_dir('Dir::State::Lists')
+            packages = [f for f in os.listdir(lists) if f.endswith('_Packages')]
+            self.assertNotEqual(packages, [])
+            with open(os.path.join(lists, packages[0]), 'a') as f:
+                f.write('\n')
+            self.assertEqual(names(), set(['vanilla']))
+        finally:
+            chroot.remove()
+
+    def test_update_modalias_index(self):
+        '''update_modalias_index() only parses changed package lists'''
+
+        segments = os.path.join(self.cache_dir, 'modalias-segments')
+        alias = 'pci:v00001234d00sv00000001sd00bc00sc00i00'
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+            UbuntuDrivers.detect.update_modalias_index(cache)
+
+            self.assertTrue(os.path.exists(os.path.join(self.cache_dir, 'modalias-index.json')))
+            states = dict((f, os.stat(os.path.join(segments, f)).st_mtime_ns) for f in os.listdir(segments))
+            self.assertIn('status.json', states)
+
+            # add a driver to one list
+            lists = apt.apt_pkg.config.find_dir('Dir::State::Lists')
+            changed = [f for f in os.listdir(lists) if f.endswith('_Packages')][0]
+            with open(os.path.join(lists, changed), 'a') as f:
+                f.write('\nPackage: strawberry\nVersion: 1\nArchitecture: all\n'
+                        'Maintainer: Test User <test@example.com>\nDescription: test package\n'
+                        'Modaliases: strawberry(pci:v00001234d*sv*sd*bc*sc*i*)\n')
+            cache.open()
+            UbuntuDrivers.detect.update_modalias_index(cache)
+            for f, mtime in states.items():
+                if f == changed + '.json':
+                    self.assertNotEqual(os.stat(os.path.join(segments, f)).st_mtime_ns, mtime)
+                else:
+                    self.assertEqual(os.stat(os.path.join(segments, f)).st_mtime_ns, mtime, f)
+
+            res = UbuntuDrivers.detect.packages_for_modalias(cache, alias)
+        finally:
+            chroot.remove()
+
+        self.assertEqual(set([p.name for p in res]), set(['vanilla', 'strawberry']))
+
+    def test_update_modalias_index_format(self):
+        '''update_modalias_index() rebuilds an index of another format'''
+
+        index = os.path.join(self.cache_dir, 'modalias-index.json')
+        alias = 'pci:v00001234d00sv00000001sd00bc00sc00i00'
+        cache = FakeCache()
+        cache.lists_dir = os.path.join(self.cache_dir, 'lists')
+        cache.status_file = os.path.join(self.cache_dir, 'status')
+        cache.package('vanilla', record={'Modaliases': 'vanilla(pci:v00001234d*sv*sd*bc*sc*i*)'})
+
+        UbuntuDrivers.detect.update_modalias_index(cache)
+        with open(index) as f:
+            key = json.loads(f.readline())
+            modalias_map = json.loads(f.readline())
+            video_abi_compat = json.loads(f.readline())
+        self.assertEqual(key[0], UbuntuDrivers.modaliasindex.MODALIAS_INDEX_FORMAT)
+
+        # an index of an older format for the same apt state is not parsed
+        key[0] -= 1
+        modalias_map['pci']['pci:v00001234d*sv*sd*bc*sc*i*'].append('chocolate')
+        with open(index, 'w') as f:
+            for part in (key, modalias_map, video_abi_compat):
+                json.dump(part, f)
+                f.write('\n')
+        UbuntuDrivers.detect.update_modalias_index(cache)
+        with open(index) as f:
+            self.assertEqual(json.loads(f.readline())[0], UbuntuDrivers.modaliasindex.MODALIAS_INDEX_FORMAT)
+            self.assertEqual(json.loads(f.readline()), {'pci': {'pci:v00001234d*sv*sd*bc*sc*i*': ['vanilla']}})
+        self.assertEqual([p.name for p in UbuntuDrivers.detect.packages_for_modalias(cache, alias)], ['vanilla'])
+
     def test_system_driver_packages_chroot(self):
         '''system_driver_packages() for test package repository'''
 
@@ -268,6 +597,145 @@ class DetectTest(unittest.TestCase):
 
         self.assertFalse(res['neapolitan']['free'])
 
+    def test_system_driver_packages_package_lists(self):
+        '''system_driver_packages() with PackageLists instead of apt.Cache'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('nvidia-34',
+                               dependencies={'Depends': 'xorg-video-abi-3 | xorg-video-abi-4'},
+                               extra_tags={'Modaliases': 'nv(pci:v000010DEd000010C3sv*sd*bc03sc*i*)'})
+            archive.create_deb('linux-image-generic')
+            archive.create_deb('linux-generic', dependencies={'Depends': 'linux-image-generic'})
+            # not a driver or kernel package used for detection, so not kept
+            archive.create_deb('coreutils-extra')
+            archive.create_deb('linux-tools-generic')
+            chroot.add_repository(archive.path, True, False)
+            sources_list = os.path.join(chroot.path, 'etc/apt/sources.list')
+            with open(sources_list, 'w') as f:
+                f.write(archive.apt_source)
+
+            cache = apt.Cache(rootdir=chroot.path)
+            cache.update()
+            cache.open()
+            res = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+
+            lists = UbuntuDrivers.packagelists.PackageLists(
+                os.path.join(chroot.path, 'var/lib/apt/lists'),
+                os.path.join(chroot.path, 'var/lib/dpkg/status'))
+            res_lists = UbuntuDrivers.detect.system_driver_packages(lists, sys_path=self.umockdev.get_sys_dir())
+        finally:
+            chroot.remove()
+
+        self.assertIn('vanilla', lists)
+        self.assertIn('xserver-xorg-core', lists)
+        self.assertNotIn('coreutils-extra', lists)
+        self.assertIn('linux-image-generic', lists)
+        self.assertIn('linux-generic', lists)
+        self.assertNotIn('linux-tools-generic', lists)
+        self.assertIn('xorg-video-abi-4', lists['xserver-xorg-core'].candidate.provides)
+
+        self.assertEqual(set(res_lists), set(res))
+        for pkg, info in res.items():
+            self.assertEqual(res_lists[pkg], info, pkg)
+        self.assertFalse(res_lists['neapolitan']['free'])
+        self.assertTrue(res_lists['vanilla']['from_distro'])
+
+    def test_package_metadata(self):
+        '''_package_metadata() computes each field once per cache'''
+
+        pl = UbuntuDrivers.packagelists
+        cache = FakeCache()
+        pkg = cache.package('nvidia-340', record={'Modaliases': 'nvidia(pci:v000010DEd*sv*sd*bc03sc*i*)',
+                                                  'Support': 'LTSB'},
+                            origins=[pl.Origin('Ubuntu', 'restricted')])
+        metadata = UbuntuDrivers.detect._package_metadata
+        self.assertEqual([metadata(cache, pkg, f) for f in ('free', 'from_distro', 'support', 'module')],
+                         [False, True, 'LTSB', 'nvidia'])
+
+        pkg.candidate.origins = [pl.Origin('Ubuntu', 'main')]
+        self.assertFalse(metadata(cache, pkg, 'free'))
+        cache.emit('cache_post_open')
+        self.assertTrue(metadata(cache, pkg, 'free'))
+
+    def test_linux_modules_for_kernels(self):
+        '''get_linux_modules_for_kernels() resolves the modules for every installed kernel'''
+
+        cache = FakeCache()
+        package = cache.package
+
+        for kernel in ('5.4.0-26-generic', '5.4.0-20-generic', '5.4.0-18-lowlatency'):
+            package('linux-image-' + kernel, installed=True)
+        package('linux-image-5.4.0-30-generic')
+        package('linux-image-generic', 'linux-image-5.4.0-26-generic', installed=True)
+        package('linux-modules-nvidia-440-5.4.0-26-generic', 'linux-image-5.4.0-26-generic')
+        package('linux-modules-nvidia-440-generic', 'linux-modules-nvidia-440-5.4.0-26-generic')
+        package('linux-modules-nvidia-440-5.4.0-20-generic', 'linux-image-5.4.0-20-generic')
+        package('linux-modules-nvidia-440-server-5.4.0-26-generic', 'linux-image-5.4.0-26-generic')
+        package('nvidia-dkms-440')
+
+        index = UbuntuDrivers.detect.linux_modules_index(cache)
+        self.assertIs(UbuntuDrivers.detect.linux_modules_index(UbuntuDrivers.detect.DetectionSession(cache)), index)
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.package('440-server', 'generic', '5.4.0-26'),
+                         'linux-modules-nvidia-440-server-5.4.0-26-generic')
+        self.assertEqual(index.package('440', 'lowlatency', '5.4.0-26'), None)
+
+        candidates = ['nvidia-driver-440', 'nvidia-driver-440-server', 'nvidia-340', 'bcmwl-kernel-source']
+        res = UbuntuDrivers.detect.get_linux_modules_for_kernels(cache, candidates)
+        self.assertEqual(list(res), ['linux-image-5.4.0-26-generic', 'linux-image-5.4.0-20-generic',
+                                     'linux-image-5.4.0-18-lowlatency'])
+        self.assertEqual(res['linux-image-5.4.0-26-generic'],
+                         {'nvidia-driver-440': 'linux-modules-nvidia-440-generic',
+                          'nvidia-driver-440-server': 'linux-modules-nvidia-440-server-5.4.0-26-generic',
+                          'nvidia-340': None, 'bcmwl-kernel-source': None})
+        self.assertEqual(res['linux-image-5.4.0-20-generic']['nvidia-driver-440'],
+                         'linux-modules-nvidia-440-5.4.0-20-generic')
+        self.assertEqual(res['linux-image-5.4.0-20-generic']['nvidia-driver-440-server'], None)
+        self.assertEqual(res['linux-image-5.4.0-18-lowlatency']['nvidia-driver-440'], 'nvidia-dkms-440')
+
+        res = UbuntuDrivers.detect.get_linux_modules_for_kernels(
+            cache, ['nvidia-driver-440'], ['linux-image-5.4.0-30-generic', 'linux-image-foo'])
+        self.assertEqual(res, {'linux-image-5.4.0-30-generic': {'nvidia-driver-440': 'nvidia-dkms-440'}})
+
+        # for the system's kernel, the ABI specific package is not used without a metapackage
+        self.assertEqual(UbuntuDrivers.detect.get_linux_modules_metapackages(cache, candidates),
+                         {'nvidia-driver-440': 'linux-modules-nvidia-440-generic',
+                          'nvidia-driver-440-server': None, 'nvidia-340': None, 'bcmwl-kernel-source': None})
+
+    def test_aptscan(self):
+        '''apt_pkg fast path gives the same results as iterating apt.Cache'''
+
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            archive.create_deb('linux-image-4.15.0-20-generic')
+            archive.create_deb('linux-image-generic',
+                               dependencies={'Depends': 'linux-image-4.15.0-20-generic'})
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+            # the same packages, without the apt_pkg objects
+            slow_cache = FakeCache(cache)
+
+            self.assertIsNotNone(UbuntuDrivers.aptscan.raw_cache(cache))
+            self.assertIsNone(UbuntuDrivers.aptscan.raw_cache(slow_cache))
+
+            res = UbuntuDrivers.detect._apt_cache_modalias_map(cache)
+            self.assertIn('pci', res)
+            self.assertEqual(res, UbuntuDrivers.detect._apt_cache_modalias_map(slow_cache))
+
+            self.assertEqual(UbuntuDrivers.detect.find_reverse_dependencies(
+                cache, 'linux-image-4.15.0-20-generic', 'linux-image'), ['linux-image-generic'])
+            self.assertEqual(UbuntuDrivers.detect.find_reverse_dependencies(
+                slow_cache, 'linux-image-4.15.0-20-generic', 'linux-image'), ['linux-image-generic'])
+        finally:
+            chroot.remove()
+
     def test_system_gpgpu_driver_packages_chroot1(self):
         '''system_gpgpu_driver_packages() for test package repository'''
 
@@ -428,9 +896,12 @@ class DetectTest(unittest.TestCase):
             res = UbuntuDrivers.detect.system_gpgpu_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
             linux_package = UbuntuDrivers.detect.get_linux(cache)
             modules_package = UbuntuDrivers.detect.get_linux_modules_metapackage(cache, 'nvidia-driver-410')
+            modules_packages = UbuntuDrivers.detect.get_linux_modules_metapackages(
+                cache, ['nvidia-driver-410', 'nvidia-340'])
         finally:
             chroot.remove()
 
+        self.assertEqual(modules_packages, {'nvidia-driver-410': modules_package, 'nvidia-340': None})
         self.assertTrue('nvidia-driver-410' in res)
         packages = UbuntuDrivers.detect.gpgpu_install_filter(res, 'nvidia')
         self.assertEqual(set(packages), set(['nvidia-driver-410']))
@@ -1154,6 +1625,37 @@ class DetectTest(unittest.TestCase):
             chroot.remove()
         self.assertTrue('oem-pistacchio-meta' in res)
 
+    def test_detection_session(self):
+        '''DetectionSession shares the apt cache and hardware scan'''
+
+        sys_dir = self.umockdev.get_sys_dir()
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+            session = UbuntuDrivers.detect.DetectionSession(cache, sys_dir)
+            self.assertIs(session.apt_cache, cache)
+
+            res = UbuntuDrivers.detect.system_driver_packages(session)
+            self.assertEqual(res, UbuntuDrivers.detect.system_driver_packages(cache, sys_path=sys_dir))
+
+            # the session keeps using the first scan
+            self.umockdev.add_device('pci', 'hotplugged', None,
+                                     ['modalias', 'pci:v00001234d01sv00000001sd00bc00sc00i00'], [])
+            devices = UbuntuDrivers.detect.system_device_drivers(session)
+            self.assertFalse([d for d in devices if d.endswith('/hotplugged')])
+            self.assertNotIn('pci:v00001234d01sv00000001sd00bc00sc00i00', session.modaliases())
+            devices = UbuntuDrivers.detect.system_device_drivers(cache, sys_path=sys_dir)
+            self.assertTrue([d for d in devices if d.endswith('/hotplugged')])
+            # ... unless a different sysfs is asked for
+            devices = UbuntuDrivers.detect.system_device_drivers(session, sys_path=os.path.join(sys_dir, '.'))
+            self.assertTrue([d for d in devices if d.endswith('/hotplugged')])
+        finally:
+            chroot.remove()
+
     def test_system_driver_packages_bad_encoding(self):
         '''system_driver_packages() with badly encoded Packages index'''
 
@@ -1259,6 +1761,32 @@ Description: broken \xEB encoding
                          {'free': True, 'from_distro': True, 'recommended': False, 'builtin': True})
         self.assertEqual(len(graphics_dict['drivers']), 5, list(graphics_dict['drivers'].keys()))
 
+    def test_system_device_drivers_shared_modalias(self):
+        '''system_device_drivers() for several devices with the same modalias'''
+
+        self.umockdev.add_device('pci', 'white2', None,
+                                 ['modalias', 'pci:v00001234d00sv00000001sd00bc00sc00i00'], [])
+        chroot = aptdaemon.test.Chroot()
+        try:
+            chroot.setup()
+            chroot.add_test_repository()
+            archive = gen_fakearchive()
+            chroot.add_repository(archive.path, True, False)
+            cache = apt.Cache(rootdir=chroot.path)
+            packages = UbuntuDrivers.detect.system_driver_packages(cache, sys_path=self.umockdev.get_sys_dir())
+            res = UbuntuDrivers.detect.system_device_drivers(cache, sys_path=self.umockdev.get_sys_dir())
+        finally:
+            chroot.remove()
+
+        self.assertEqual(sorted(os.path.basename(p) for p in packages['vanilla']['syspaths']),
+                         ['white', 'white2'])
+        for device in ('white', 'white2'):
+            device_dict = [value for key, value in res.items() if key.endswith('/sys/devices/' + device)][0]
+            self.assertEqual(device_dict,
+                             {'modalias': 'pci:v00001234d00sv00000001sd00bc00sc00i00',
+                              'drivers': {'vanilla': {'free': True, 'from_distro': False}}
+                              })
+
     def test_system_device_drivers_detect_plugins(self):
         '''system_device_drivers() includes custom detection plugins'''
 
@@ -1281,23 +1809,21 @@ Description: broken \xEB encoding
             chroot.add_repository(archive.path, True, False)
             cache = apt.Cache(rootdir=chroot.path)
 
-            # add a wrapper modinfo binary
-            with open(os.path.join(chroot.path, 'modinfo'), 'w') as f:
-                f.write('''#!/bin/sh -e
-if [ "$1" = nvidia ]; then
-    echo "filename:  /some/path/nvidia.ko"
-    exit 0
-fi
-exec /sbin/modinfo "$@"
-''')
-            os.chmod(os.path.join(chroot.path, 'modinfo'), 0o755)
-            orig_path = os.environ['PATH']
-            os.environ['PATH'] = '%s:%s' % (chroot.path, os.environ['PATH'])
+            # add a fake module tree with an nvidia module
+            modules_dir = os.path.join(chroot.path, 'modules')
+            os.mkdir(modules_dir)
+            with open(os.path.join(modules_dir, 'modules.dep'), 'w') as f:
+                f.write('kernel/drivers/video/nvidia.ko:\n')
+            orig_modules_dir = os.environ.get('UBUNTU_DRIVERS_MODULES_DIR')
+            os.environ['UBUNTU_DRIVERS_MODULES_DIR'] = modules_dir
 
             res = UbuntuDrivers.detect.system_device_drivers(cache, sys_path=self.umockdev.get_sys_dir())
         finally:
             chroot.remove()
-            os.environ['PATH'] = orig_path
+            if orig_modules_dir is None:
+                os.environ.pop('UBUNTU_DRIVERS_MODULES_DIR', None)
+            else:
+                os.environ['UBUNTU_DRIVERS_MODULES_DIR'] = orig_modules_dir
 
         graphics = '/sys/devices/graphics'
         graphics_dict = [value for key, value in res.items() if key.endswith(graphics)][0]
@@ -1448,6 +1974,19 @@ exec /sbin/modinfo "$@"
             logging.getLogger().setLevel(logging.INFO)
             chroot.remove()
 
+    def test_detect_plugin_packages_video_abi(self):
+        '''detect_plugin_packages() checks the video ABI without building the modalias index'''
+
+        cache = FakeCache()
+        cache.package('xserver-xorg-core', record={'Provides': 'xorg-video-abi-4'})
+        cache.package('nvidia-new', depends='xorg-video-abi-4')
+        cache.package('nvidia-old', depends='xorg-video-abi-3')
+        with open(os.path.join(self.plugin_dir, 'nvidia.py'), 'w') as f:
+            f.write('def detect(apt): return ["nvidia-new", "nvidia-old"]\n')
+
+        self.assertEqual(UbuntuDrivers.detect.detect_plugin_packages(cache), {'nvidia.py': ['nvidia-new']})
+        self.assertIsNone(UbuntuDrivers.detect.packages_for_modalias.cache_maps.peek(cache))
+
     def _gen_detect_plugins(self):
         '''Generate some custom detection plugins in self.plugin_dir.'''
 
@@ -1693,7 +2232,14 @@ APT::Get::AllowUnauthenticated "true";
         self.umockdev = gen_fakehw()
         os.environ['UBUNTU_DRIVERS_SYS_DIR'] = self.umockdev.get_sys_dir()
 
+        # do not use or clobber the system's modalias snapshot and index
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = self.cache_dir
+
     def tearDown(self):
+        shutil.rmtree(self.cache_dir)
+        del os.environ['UBUNTU_DRIVERS_CACHE_DIR']
+
         # some tests install this package
         apt = subprocess.Popen(['apt-get', 'purge', '-y', 'bcmwl-kernel-source'],
                                stdout=subprocess.PIPE)
@@ -1864,6 +2410,387 @@ class PluginsTest(unittest.TestCase):
         self.assertEqual(ud.returncode, 0)
 
 
+class ModaliasMatcherTest(unittest.TestCase):
+    '''Test UbuntuDrivers.modaliasmatcher'''
+
+    modalias_map = {
+        'pci': {'pci:v00001234d*sv*sd*bc*sc*i*': set(['vanilla']),
+                'pci:v0000BEEFd*sv*sd*bc*sc*i00': set(['chocolate', 'tuttifrutti']),
+                'pci:v000010DEd000010C3sv*sd*bc03sc*i*': set(['nvidia-current', 'nvidia-old']),
+                'pci:v000010DEd000010C?sv*sd*bc03sc*i*': set(['nvidia-any']),
+                'pci:*sv00001028sd00000962*': set(['oem-pistacchio-meta']),
+                'pci:vDEADBEEFd00': set(['exact'])},
+        'usb': {'usb:v9876dABCDsv*sd*bc00sc*i*': set(['chocolate']),
+                'usb:v0BDAp8179d*dc*dsc*dp*ic*isc*ip*in*': set(['rtl8188eu']),
+                'usb:v0BDAp*d*dc*dsc*dp*icFFiscFFipFFin*': set(['realtek-any'])},
+        'dmi': {'dmi:*pnXPS137390:*': set(['oem-pistacchio-meta']),
+                'dmi:*:svnLENOVO:pn20HRCTO1WW:*': set(['oem-lenovo-meta']),
+                'dmi:*:pn*Latitude*:*': set(['oem-latitude-meta'])},
+    }
+
+    def test_match(self):
+        '''ModaliasMatcher.match() agrees with fnmatch'''
+
+        matcher = UbuntuDrivers.modaliasmatcher.ModaliasMatcher(self.modalias_map)
+        aliases = ['pci:v00001234d00sv00000001sd00bc00sc00i00',
+                   'pci:v0000beefd00sv00000001sd00bc00sc00i00',
+                   'pci:v0000BEEFd00sv00000001sd00bc00sc00i01',
+                   modalias_nv,
+                   'pci:v000010DEd000010C4sv00003842sd00002670bc03sc03i00',
+                   'pci:v00008086d00001234sv00001028sd00000962bc03sc00i00',
+                   'pci:vDEADBEEFd00', 'pci:vDEADBEEFd0000',
+                   'usb:v9876dABCDsv01sd02bc00sc01i05',
+                   'usb:v0BDAp8179d0000dc00dsc00dp00icFFiscFFipFFin00',
+                   'usb:v0BDAp8178d0000dc00dsc00dp00icFFiscFFipFFin00',
+                   'usb:v0BDAp8178d0000dc00dsc00dp00ic08isc06ip50in00',
+                   'dmi:aaapnXPS137390:a', 'dmi:bvnDell:pnXPS137390:pvr',
+                   'dmi:bvnDell:pnXPS13739:pvr',
+                   'dmi:bvnLENOVO:bvrN23ET:svnLENOVO:pn20HRCTO1WW:pvrThinkPadX1:',
+                   'dmi:bvnLENOVO:bvrN23ET:svnDell:pn20HRCTO1WW:pvrThinkPadX1:',
+                   'dmi:bvnDell:svnDell:pnLatitude 7490:pvr:',
+                   'acpi:ABC:', 'pci:']
+        for alias in aliases:
+            expected = set()
+            for pattern, pkgs in self.modalias_map.get(alias.split(':', 1)[0], {}).items():
+                if fnmatch.fnmatch(alias.lower(), pattern.lower()):
+                    expected.update(pkgs)
+            self.assertEqual(matcher.match(alias), expected, alias)
+
+        self.assertEqual(matcher.match(modalias_nv),
+                         set(['nvidia-current', 'nvidia-old', 'nvidia-any']))
+        self.assertEqual(matcher.match('pci:vDEADBEEFd00'), set(['exact']))
+        self.assertEqual(matcher.match('usb:v0BDAp8179d0000dc00dsc00dp00icFFiscFFipFFin00'),
+                         set(['rtl8188eu', 'realtek-any']))
+        self.assertEqual(matcher.match('dmi:bvnLENOVO:bvrN23ET:svnLENOVO:pn20HRCTO1WW:pvrThinkPadX1:'),
+                         set(['oem-lenovo-meta']))
+
+    def test_pci_index(self):
+        '''_PciIndex agrees with fnmatch'''
+
+        patterns = {
+            # exact vendor and device
+            'pci:v000010DEd000010C3sv*sd*bc03sc*i*': 'nv-exact',
+            'pci:v000010DEd000010C3sv00003842sd00002670bc03sc03i00': 'nv-full',
+            # wildcard device, wildcard vendor
+            'pci:v000010DEd*sv*sd*bc03sc*i*': 'nv-any',
+            'pci:v*d*sv00001028sd00000962bc*sc*i*': 'dell-sub',
+            'pci:*sv00001028sd00000962*': 'dell-glob',
+            # ? and [...] fall back to glob matching
+            'pci:v000010DEd000010C?sv*sd*bc03sc*i*': 'nv-question',
+            'pci:v000010DEd000010[Cc][0-4]sv*sd*bc03sc*i*': 'nv-range',
+            'pci:v00008086d*sv*sd*bc0[23]sc*i*': 'intel-class',
+            # lower case hex
+            'pci:v0000beefd*sv*sd*bc*sc*i00': 'beef',
+        }
+        compact = UbuntuDrivers.modaliasmatcher.CompactModaliasMap(
+            {'pci': dict((pattern, [package]) for pattern, package in patterns.items())}, lower=True)
+        index = UbuntuDrivers.modaliasmatcher._PciIndex(compact['pci'])
+        for i in range(len(compact['pci'])):
+            index.add(i, compact['pci'].pattern(i))
+
+        aliases = ['pci:v000010DEd000010C3sv00003842sd00002670bc03sc03i00',
+                   'pci:v000010ded000010c3sv00003842sd00002670bc03sc03i00',
+                   'pci:v000010DEd000010C3sv00003842sd00002670bc02sc03i00',
+                   'pci:v000010DEd000010C5sv00000000sd00000000bc03sc00i00',
+                   'pci:v000010DEd000010CAsv00000000sd00000000bc03sc00i00',
+                   'pci:v00008086d00001234sv00001028sd00000962bc03sc00i00',
+                   'pci:v00008086d00001234sv00001028sd00000963bc02sc00i00',
+                   'pci:v0000BEEFd00000001sv00000000sd00000000bc00sc00i00',
+                   'pci:v0000BEEFd00000001sv00000000sd00000000bc00sc00i01',
+                   # not well-formed
+                   'pci:v000010DEd000010C3', 'pci:vDEADBEEFd00', 'pci:v000010DEd000010C3sv00001028sd00000962']
+        for alias in aliases:
+            expected = set(package for pattern, package in patterns.items()
+                           if fnmatch.fnmatch(alias.lower(), pattern.lower()))
+            result = set()
+            index.match(alias.lower(), result)
+            self.assertEqual(set(compact.names[i] for i in result), expected, alias)
+
+    def test_compact_map(self):
+        '''CompactModaliasMap'''
+
+        compact = UbuntuDrivers.modaliasmatcher.CompactModaliasMap(self.modalias_map)
+        self.assertEqual(set(compact), set(self.modalias_map))
+        self.assertIn('pci', compact)
+        self.assertNotIn('acpi', compact)
+        for bus, aliases in self.modalias_map.items():
+            self.assertEqual(len(compact[bus]), len(aliases))
+            self.assertEqual(list(compact[bus]), sorted(aliases))
+            for pattern, pkgs in aliases.items():
+                self.assertIn(pattern, compact[bus])
+                self.assertEqual(compact[bus][pattern], tuple(sorted(pkgs)))
+            self.assertEqual(dict(compact[bus].items()),
+                             dict((p, tuple(sorted(pkgs))) for p, pkgs in aliases.items()))
+        self.assertRaises(KeyError, compact['pci'].__getitem__, 'pci:v*')
+        self.assertEqual(compact.get('acpi'), None)
+
+        # package names are interned
+        self.assertEqual(compact.names, sorted(set(compact.names)))
+
+        matcher = UbuntuDrivers.modaliasmatcher.ModaliasMatcher(compact)
+        self.assertEqual(matcher.match(modalias_nv),
+                         set(['nvidia-current', 'nvidia-old', 'nvidia-any']))
+
+    def test_memory(self):
+        '''ModaliasMatcher keeps the patterns only once'''
+
+        def mkmap():
+            modalias_map = {'pci': {}, 'usb': {}, 'dmi': {}}
+            for i in range(3000):
+                modalias_map['pci']['pci:v000010DEd0000%04Xsv*sd*bc03sc*i*' % i] = set(['nvidia-%i' % (i % 10)])
+                modalias_map['usb']['usb:v%04Xp%04Xd*dc*dsc*dp*ic*isc*ip*in*' % (i, i)] = set(['usb-%i' % (i % 50)])
+                modalias_map['dmi']['dmi:*:svnDell*:pnProduct%05i:*' % i] = set(['oem-%i-meta' % (i % 50)])
+            # patterns which only differ in case are merged
+            modalias_map['pci']['pci:v000010ded00000001sv*sd*bc03sc*i*'] = set(['nvidia-lower'])
+            return modalias_map
+
+        def traced_size(fn):
+            gc.collect()
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                obj = fn()
+                gc.collect()
+                return (obj, tracemalloc.get_traced_memory()[0] - before)
+            finally:
+                tracemalloc.stop()
+
+        (modalias_map, map_size) = traced_size(mkmap)
+        (matcher, matcher_size) = traced_size(lambda: UbuntuDrivers.modaliasmatcher.ModaliasMatcher(modalias_map))
+        # the indexes only refer to pattern numbers in the lower case compact map
+        self.assertLess(matcher_size, map_size / 2)
+        self.assertEqual(matcher.match('pci:v000010DEd00000BB7sv00000000sd00000000bc03sc00i00'), set(['nvidia-9']))
+        self.assertEqual(matcher.match('pci:v000010DEd00000001sv00000000sd00000000bc03sc00i00'),
+                         set(['nvidia-1', 'nvidia-lower']))
+
+    def test_cache(self):
+        '''ModaliasMatcherCache'''
+
+        builds = []
+
+        def build(apt_cache):
+            builds.append(id(apt_cache))
+            return UbuntuDrivers.modaliasmatcher.ModaliasMatcher(self.modalias_map)
+
+        cache = UbuntuDrivers.modaliasmatcher.ModaliasMatcherCache(build, maxsize=2)
+        c1 = FakeCache()
+        c2 = FakeCache()
+        c3 = FakeCache()
+        self.assertIsNone(cache.peek(c1))
+        m1 = cache.get(c1)
+        self.assertIs(cache.get(c1), m1)
+        self.assertIs(cache.peek(c1), m1)
+        cache.get(c2)
+        # c1 was used more recently than c2, so c2 gets evicted
+        cache.get(c1)
+        cache.get(c3)
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.peek(c2))
+        self.assertIs(cache.get(c1), m1)
+        self.assertEqual(builds, [id(c1), id(c2), id(c3)])
+
+        # reopening drops the matcher, but only connects once
+        c1.emit('cache_post_open')
+        self.assertIsNot(cache.get(c1), m1)
+        self.assertEqual(list(c1.callbacks), ['cache_post_open'])
+        self.assertEqual(len(c1.callbacks['cache_post_open']), 1)
+
+        # entries go away with their apt cache
+        del c3
+        self.assertEqual(len(cache), 1)
+
+        cache.invalidate(c1)
+        self.assertEqual(len(cache), 0)
+        cache.get(c1)
+        cache.get(c2)
+        cache.invalidate()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(len(builds), 6)
+
+
+class AptScanTest(unittest.TestCase):
+    '''Test UbuntuDrivers.aptscan'''
+
+    def test_prefix_index(self):
+        '''PrefixIndex lookups'''
+
+        index = UbuntuDrivers.aptscan.PrefixIndex([
+            'linux-image-generic', 'nvidia-340', 'linux-image-5.4.0-1-generic', 'linux-headers-generic',
+            'linux', 'linuxfoo-bar', 'nvidia-driver-440', 'nvidia-settings:i386', 'oem-somerville-meta',
+            'vim'])
+        self.assertEqual(len(index), 10)
+        self.assertEqual(index.names('linux-image'), ['linux-image-5.4.0-1-generic', 'linux-image-generic'])
+        self.assertEqual(index.names('linux-image-generic'), ['linux-image-generic'])
+        self.assertEqual(index.names('nvidia-'), ['nvidia-340', 'nvidia-driver-440', 'nvidia-settings:i386'])
+        self.assertEqual(index.names('oem-'), ['oem-somerville-meta'])
+        self.assertEqual(index.names('linux'), ['linux', 'linux-headers-generic', 'linux-image-5.4.0-1-generic',
+                                                'linux-image-generic', 'linuxfoo-bar'])
+        self.assertEqual(index.names('fglrx-'), [])
+        self.assertEqual(index.names('linux-modules-nvidia-'), [])
+
+    def test_generation(self):
+        '''generation() counts the changes of a cache'''
+
+        cache = FakeCache()
+        other = FakeCache()
+        self.assertEqual(UbuntuDrivers.aptscan.generation(cache), 0)
+        self.assertEqual(UbuntuDrivers.aptscan.generation(cache), 0)
+        self.assertEqual(len(cache.callbacks['cache_post_change']), 1)
+        cache.emit('cache_post_change')
+        cache.emit('cache_post_change')
+        self.assertEqual(UbuntuDrivers.aptscan.generation(cache), 2)
+        cache.emit('cache_post_open')
+        self.assertEqual(UbuntuDrivers.aptscan.generation(cache), 3)
+        self.assertEqual(UbuntuDrivers.aptscan.generation(other), 0)
+
+        # kernel detection results are dropped on changes
+        results = UbuntuDrivers.detect._kernel_results(cache)
+        results['image'] = 'linux-image-generic'
+        self.assertEqual(UbuntuDrivers.detect._kernel_results(cache), {'image': 'linux-image-generic'})
+        self.assertEqual(UbuntuDrivers.detect._kernel_results(other), {})
+        cache.emit('cache_post_change')
+        self.assertEqual(UbuntuDrivers.detect._kernel_results(cache), {})
+
+    def test_cache_memo(self):
+        '''CacheMemo keeps values per cache until it changes'''
+
+        builds = []
+
+        def build(apt_cache):
+            builds.append(apt_cache)
+            return len(builds)
+
+        memo = UbuntuDrivers.aptscan.CacheMemo(build)
+        memo_generation = UbuntuDrivers.aptscan.CacheMemo(build, generation=True)
+        cache = FakeCache()
+        other = FakeCache()
+        self.assertEqual(memo.get(cache), 1)
+        self.assertEqual(memo.get(cache), 1)
+        self.assertEqual(memo.get(other), 2)
+        self.assertEqual(memo_generation.get(cache), 3)
+        self.assertEqual(len(memo), 2)
+        # signals are only connected once per cache
+        self.assertEqual(len(cache.callbacks['cache_post_open']), 1)
+        self.assertEqual(len(cache.callbacks['cache_post_change']), 1)
+
+        # marking packages only invalidates memos with generation check
+        cache.emit('cache_post_change')
+        self.assertEqual(memo.get(cache), 1)
+        self.assertEqual(memo_generation.get(cache), 4)
+
+        # reopening invalidates everything
+        cache.emit('cache_post_open')
+        self.assertEqual(memo.get(cache), 5)
+        self.assertEqual(memo_generation.get(cache), 6)
+        self.assertEqual(memo.get(other), 2)
+
+        memo.invalidate(other)
+        self.assertEqual(memo.get(other), 7)
+        memo.invalidate()
+        self.assertEqual(len(memo), 0)
+
+        # values do not keep their cache alive
+        memo_generation.get(other)
+        self.assertEqual(len(memo_generation), 2)
+        del builds[:]
+        del other
+        gc.collect()
+        self.assertEqual(len(memo_generation), 1)
+
+    def test_reverse_depends_index(self):
+        '''ReverseDependsIndex of candidate and installed Depends'''
+
+        cache = FakeCache()
+        cache.package('linux-generic', 'linux-image-generic, linux-headers-generic')
+        cache.package('linux-image-generic', 'linux-image-5.4.0-2-generic | linux-image-5.4.0-1-generic',
+                      installed='linux-image-5.4.0-1-generic', record={'PreDepends': 'linux-base'})
+        cache.package('linux-modules-nvidia-440-generic', 'linux-image-5.4.0-2-generic (= 5.4.0-2.2)')
+        cache.package('linux-image-5.4.0-2-generic')
+
+        index = UbuntuDrivers.aptscan.ReverseDependsIndex(cache)
+        self.assertEqual(index.reverse_depends('linux-image-generic'), {'linux-generic'})
+        self.assertEqual(index.reverse_depends('linux-image-5.4.0-2-generic'),
+                         {'linux-image-generic', 'linux-modules-nvidia-440-generic'})
+        self.assertEqual(index.reverse_depends('linux-image-5.4.0-1-generic'), {'linux-image-generic'})
+        self.assertEqual(index.reverse_depends('linux-base'), set())
+        self.assertEqual(index.reverse_depends('linux-generic'), set())
+
+
+class HwdbTest(unittest.TestCase):
+    '''Test UbuntuDrivers.hwdb'''
+
+    def test_lookup(self):
+        '''hwdb.bin lookups agree with udevadm hwdb'''
+
+        if UbuntuDrivers.hwdb.get_hwdb() is None or not shutil.which('udevadm'):
+            self.skipTest('needs hwdb.bin and udevadm')
+
+        for alias in ['pci:v000010DEd000010C3sv00003842sd00002670bc03sc03i00',
+                      'usb:v1D6Bp0002d0504dc09dsc00dp01ic09isc00ip00in00',
+                      'pci:v00001234d00sv00000001sd00bc00sc00i00']:
+            self.assertEqual(UbuntuDrivers.hwdb.lookup(alias),
+                             UbuntuDrivers.detect._udevadm_hwdb(alias), alias)
+        self.assertIn('NVIDIA', UbuntuDrivers.hwdb.lookup(
+            'pci:v000010DEd000010C3sv00003842sd00002670bc03sc03i00')['ID_VENDOR_FROM_DATABASE'])
+
+
+class KmodIndexTest(unittest.TestCase):
+    '''Test UbuntuDrivers.kmodindex'''
+
+    def test_text_tree(self):
+        '''ModuleIndex on a module tree with text indexes'''
+
+        d = tempfile.mkdtemp()
+        try:
+            os.mkdir(os.path.join(d, 'modprobe.d'))
+            with open(os.path.join(d, 'modules.dep'), 'w') as f:
+                f.write('kernel/drivers/video/nvidia.ko: kernel/drivers/misc/drm.ko\n'
+                        'kernel/drivers/misc/drm.ko:\n'
+                        'kernel/drivers/net/wl-test.ko.xz:\n')
+            with open(os.path.join(d, 'modules.alias'), 'w') as f:
+                f.write('# Aliases extracted from modules themselves.\n'
+                        'alias pci:v000010DEd*sv*sd*bc03sc*i* nvidia\n'
+                        'alias pci:v000014E4d00004353sv*sd*bc*sc*i* wl_test\n')
+            with open(os.path.join(d, 'modules.builtin'), 'w') as f:
+                f.write('kernel/drivers/usb/usbcore.ko\n')
+            with open(os.path.join(d, 'modprobe.d', 'nvidia.conf'), 'w') as f:
+                f.write('alias nvidia-current \\\n  nvidia\ninstall fake /bin/true\n')
+            index = UbuntuDrivers.kmodindex.ModuleIndex(d, [os.path.join(d, 'modprobe.d')])
+
+            self.assertTrue(index.available())
+            self.assertEqual(index.lookup('nvidia'), ['nvidia'])
+            self.assertEqual(index.lookup('wl-test'), ['wl_test'])
+            self.assertEqual(index.lookup('nvidia-current'), ['nvidia'])
+            self.assertEqual(index.lookup('pci:v000010DEd000010C3sv00sd01bc03sc00i00'), ['nvidia'])
+            self.assertEqual(index.lookup('pci:v000010DEd000010C3sv00sd01bc02sc00i00'), [])
+            self.assertEqual(index.lookup('fake'), ['fake'])
+
+            self.assertTrue(index.module_available('nvidia'))
+            self.assertTrue(index.module_available('nvidia_current'))
+            self.assertTrue(index.module_available('usbcore'))
+            self.assertTrue(index.module_available('pci:v000014E4d00004353sv00sd01bc02sc80i00'))
+            self.assertFalse(index.module_available('fglrx'))
+            # install commands do not make a module available
+            self.assertFalse(index.module_available('fake'))
+
+            self.assertFalse(UbuntuDrivers.kmodindex.ModuleIndex(
+                os.path.join(d, 'nonexisting')).available())
+        finally:
+            shutil.rmtree(d)
+
+    def test_system_tree(self):
+        '''ModuleIndex lookups agree with modprobe --resolve-alias'''
+
+        if UbuntuDrivers.kmodindex.get_module_index() is None or not shutil.which('modprobe'):
+            self.skipTest('needs a module tree and modprobe')
+
+        for alias in ['usbcore', 'snd-hda-intel', 'pci:v00008086d00002668sv*sd*bc04sc03i00',
+                      'usb:v1D6Bp0002d0504dc09dsc00dp01ic09isc00ip00in00', 'no_such_module']:
+            out = subprocess.run(['modprobe', '--resolve-alias', alias], stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL, universal_newlines=True).stdout
+            self.assertEqual(UbuntuDrivers.kmodindex.resolve_alias(alias), out.split(), alias)
+
+
 class KernelDectionTest(unittest.TestCase):
     '''Test UbuntuDrivers.kerneldetection'''
 
@@ -1877,8 +2804,33 @@ class KernelDectionTest(unittest.TestCase):
         os.environ['UBUNTU_DRIVERS_DETECT_DIR'] = self.plugin_dir
         os.environ['UBUNTU_DRIVERS_SYS_DIR'] = self.umockdev.get_sys_dir()
 
+        # do not use or clobber the system's modalias snapshot and index
+        self.cache_dir = tempfile.mkdtemp()
+        os.environ['UBUNTU_DRIVERS_CACHE_DIR'] = self.cache_dir
+
     def tearDown(self):
         shutil.rmtree(self.plugin_dir)
+        shutil.rmtree(self.cache_dir)
+        del os.environ['UBUNTU_DRIVERS_CACHE_DIR']
+
+    def test_kernel_inventory(self):
+        '''KernelInventory parses and orders linux-image packages'''
+
+        inventory = UbuntuDrivers.kerneldetection.KernelInventory([
+            'linux-image-4.15.0-20-generic', 'linux-image-5.0.0-9-lowlatency', 'linux-image-5.0.0-27-generic',
+            'linux-image-5.0.0-27-lowlatency', 'linux-image-generic', 'linux-image-5.0.0-100-oem',
+            'linux-image-unsigned-5.0.0-27-generic', 'linux-image-generic-hwe-18.04'])
+
+        # metapackages are not images
+        self.assertEqual(len(inventory), 6)
+        self.assertEqual([i.name for i in inventory.images],
+                         ['linux-image-5.0.0-100-oem', 'linux-image-5.0.0-27-generic',
+                          'linux-image-5.0.0-27-lowlatency', 'linux-image-unsigned-5.0.0-27-generic',
+                          'linux-image-5.0.0-9-lowlatency', 'linux-image-4.15.0-20-generic'])
+        self.assertEqual(inventory.images[1], UbuntuDrivers.kerneldetection.LinuxImage(
+            'linux-image-5.0.0-27-generic', '5.0.0-27', '27', 'generic'))
+        self.assertEqual(inventory.images[3], UbuntuDrivers.kerneldetection.LinuxImage(
+            'linux-image-unsigned-5.0.0-27-generic', '5.0.0-27', '27', 'generic'))
 
     def test_linux_headers_detection_chroot(self):
         '''get_linux_headers_metapackage() for test package repository'''